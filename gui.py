@@ -1,6 +1,7 @@
 # import matplotlib
 # matplotlib.use('WXAgg')
 
+import multiprocessing
 from lib.hkeplot import GraphApp
 # from hkeplot import GraphApp
 
@@ -17,9 +18,14 @@ from lib.hkeplot import GraphApp
 # ys = np.sin(xs)
 # plotter.plot(xs, ys)
 
-app = GraphApp(0)
-#app = GraphApp(redirect='log.txt')
-fgf = app.fGraphFrame
-fmf = app.fMainFrame
-# fmf.add_model(model)
-app.MainLoop()
+if __name__ == '__main__':
+    # Figures are saved in worker processes, which must not start
+    # another GUI when they import this module (Windows, frozen builds)
+    multiprocessing.freeze_support()
+
+    app = GraphApp(0)
+    #app = GraphApp(redirect='log.txt')
+    fgf = app.fGraphFrame
+    fmf = app.fMainFrame
+    # fmf.add_model(model)
+    app.MainLoop()
@@ -6,6 +6,7 @@ in a pylab environment, so some imports are assumed.
 
 from pylab import *
 from HKEBinaryFile import HKEBinaryFile as BinaryFile
+from hkeio import extract_registers
 from scipy.interpolate import interp1d  # For cal curve interpolation
                                         # functions
                                         # import scipy.interpolate.interp1d
@@ -41,17 +42,25 @@ def SHINYload(hkefname, calfname):
 
     f = BinaryFile(hkefname)
 
+    # Extract all of the registers in one sweep of the file
+    tname = 'SHINY_T4 (5-TRead_Standard)'
+    r1name = 'SHINY_T3 (8-TRead_LR)'
+    r2name = 'SHINY_T1 (4-TRead_LR)'
+    regnames = [name + rtype for name in (tname, r1name, r2name)
+                for rtype in (': Demod', ': ADac')]
+    regdata = extract_registers(f, regnames)
+
     # Thermometer data
-    dataT = f.get_data('SHINY_T4 (5-TRead_Standard): Demod')
+    dataT = regdata[tname + ': Demod']
     dataT = dataT[..., 0]
     Ts = TofR(dataT)
 
     # Side 1 resistances
-    dataR1 = f.get_data('SHINY_T3 (8-TRead_LR): Demod')
+    dataR1 = regdata[r1name + ': Demod']
     dataR1 = dataR1.T
 
     # Side 2 resistances
-    dataR2 = f.get_data('SHINY_T1 (4-TRead_LR): Demod')
+    dataR2 = regdata[r2name + ': Demod']
     dataR2 = dataR2.T
 
     # Transition temperatures (midpoint method)
@@ -59,12 +68,12 @@ def SHINYload(hkefname, calfname):
     Tcs2 = array([find_mid_temp(rs, Ts) for rs in dataR2])
 
     # Excitation currents
-    IsT = f.get_data('SHINY_T4 (5-TRead_Standard): ADac')[0]
+    IsT = regdata[tname + ': ADac'][0]
 
-    Is1 = f.get_data('SHINY_T3 (8-TRead_LR): ADac')
+    Is1 = regdata[r1name + ': ADac']
     Is1 = Is1.T
 
-    Is2 = f.get_data('SHINY_T1 (4-TRead_LR): ADac')
+    Is2 = regdata[r2name + ': ADac']
     Is2 = Is2.T
 
     # Collect data into dictionary
@@ -21,6 +21,19 @@ class GraphFrame(wx.Frame):
         wx.Frame.__init__(self, None, wx.ID_ANY,
                           title=self.title, style=styles)
 
+        # The HKEPlotter serving the figure, used for the cursor readout
+        self.plotter = None
+
+        # Image of the axes area with the data, captured on every full
+        # draw, for text-only redraws; see redraw()
+        self.background = None
+        self._textonly = False
+
+        # Whether the plotter's cursor index predates the last draw; it
+        # is rebuilt on the first mouse motion after a draw
+        self._cursorstale = True
+        self.statusbar = self.CreateStatusBar()
+
         self.panel = wx.Panel(self)
         bsPlot, cPlot, tbPlot = self.create_plot_box(self.panel)
 
@@ -65,6 +78,9 @@ class GraphFrame(wx.Frame):
             lines = [ax.lines for ax in axes]
 
         canvas = FigCanvas(parent, -1, fig)
+        canvas.mpl_connect('draw_event', self.onDraw)
+        canvas.mpl_connect('motion_notify_event', self.onMotion)
+        canvas.mpl_connect('button_press_event', self.onMotion)
 
         bsPlot = wx.BoxSizer(wx.VERTICAL)
         bsPlot.Add(canvas, 1, flag=wx.GROW)
@@ -109,6 +125,7 @@ class GraphFrame(wx.Frame):
 
         self.cPlot.Destroy()
         self.tbPlot.Destroy()
+        self.background = None
 
         bsPlot, cPlot, tbPlot = self.create_plot_box(self.panel,
                                                      figure=newfigure)
@@ -122,5 +139,82 @@ class GraphFrame(wx.Frame):
 
         oldsizer.Layout()
 
+    def redraw(self, figure, textonly=False):
+        """
+        Redraw figure. The canvas is only replaced if figure is not
+        the one it already shows.
+
+        If textonly is True, only the text outside the axes (title and
+        labels) has changed. The data artists are then not redrawn;
+        the image of the axes area captured at the last full draw is
+        pasted back instead. Otherwise the data or view have changed,
+        so the toolbar's view history is reset, as when the figure is
+        replaced.
+        """
+        canvas = self.cPlot
+        if canvas.figure is not figure:
+            self.replace_figure(figure)
+            return
+        if not (textonly and self.background):
+            if self.tbPlot is not None:
+                self.tbPlot.update()
+            canvas.draw()
+            return
+
+        artists = []
+        for axes in figure.axes:
+            artists.extend(axes.lines + axes.collections + axes.images)
+        animated = [a.get_animated() for a in artists]
+        for a in artists:
+            a.set_animated(True)
+        self._textonly = True
+        try:
+            canvas.draw()
+        finally:
+            self._textonly = False
+            for a, anim in zip(artists, animated):
+                a.set_animated(anim)
+        for region in self.background:
+            canvas.restore_region(region)
+        canvas.blit(figure.bbox)
+
+    def onDraw(self, event):
+        """
+        Capture the data area for text-only redraws and mark the
+        plotter's cursor index as out of date for the new view.
+        """
+        if self._textonly:
+            return
+        canvas = event.canvas
+        self.background = [canvas.copy_from_bbox(axes.bbox)
+                           for axes in canvas.figure.axes]
+        self._cursorstale = True
+
+    def onMotion(self, event):
+        """
+        Show the data point nearest the mouse in the status bar. The
+        cursor index is rebuilt here rather than on every draw, so
+        panning and zooming, during which a button is held, do not pay
+        for it frame by frame.
+        """
+        plotter = self.plotter
+        # Only the R vs T axes have a cursor index, not a heatmap
+        if ((plotter is None) or (event.inaxes is None) or
+            (plotter.figure is not event.canvas.figure) or
+            (event.inaxes is not plotter.axes)):
+            self.statusbar.SetStatusText('')
+            return
+        if self._cursorstale:
+            if event.button is not None:
+                return
+            plotter.build_cursor_index()
+            self._cursorstale = False
+        point = self.plotter.nearest_point(event.x, event.y)
+        if point is None:
+            self.statusbar.SetStatusText('')
+            return
+        text = "T = {T:.6g} K, R = {R:.6g} Ohm, {label}".format(**point)
+        self.statusbar.SetStatusText(text)
+
     def onClose(self, event):
         pass
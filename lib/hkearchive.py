@@ -0,0 +1,194 @@
+"""
+Export of HKEModel entries to, and fast reloading from, an archive
+file.
+
+The archive is a numpy .npz (zip) file. Every array, i.e. the data,
+Tcs, transition widths and fit residuals, Tc errors and channel
+summaries of each board and the temperatures and calibration curve of
+each entry, is stored as a separately compressed member, so individual
+boards can be read back without inflating the rest of the archive. An
+'index' member holds a JSON description of the entries, i.e. their
+boards dictionaries and temperature information, with the names of the
+members holding their arrays.
+
+Example usage:
+
+>>> export_entries(hkem, 'run7.hkez', ['hke_20130201_001.dat'])
+>>> for name, df in load_entries('run7.hkez', boards=[8]):
+...     hkem.add_datafile(name, df)
+"""
+
+import json
+from numpy import *
+from scipy.interpolate import interp1d
+
+
+version = 1
+
+# The arrays of each board that are stored, if present
+archived = ('data', 'Tcs', 'Tcwidths', 'Tcresiduals', 'Tcerrors',
+            'summary')
+
+
+def export_entries(model, fname, names=None):
+    """
+    Write the entries names (by default all) of model to the archive
+    file fname.
+    """
+    if names is None:
+        names = model.keys()
+
+    arrays = {}
+    entries = []
+    for i, name in enumerate(names):
+        df = model[name]
+        prefix = 'entry{0}_'.format(i)
+
+        tdict = df['temperature']
+        RofT = tdict['RofT']
+        arrays[prefix + 'Ts'] = tdict['Ts']
+        arrays[prefix + 'cal'] = array([RofT.x, RofT.y])
+        temperature = {'address': tdict['address'],
+                       'channel': tdict['channel'],
+                       'Ts': prefix + 'Ts',
+                       'cal': prefix + 'cal'}
+
+        boards = []
+        for addr, board in df['boards'].items():
+            bd = {'address': addr,
+                  'type': board['type'],
+                  'name': board['name'],
+                  'register_name': board.get('register_name'),
+                  'registers': board['registers'].values()}
+            for key in archived:
+                if board.get(key) is not None:
+                    member = '{0}board{1}_{2}'.format(prefix, addr, key)
+                    arrays[member] = board[key]
+                    bd[key] = member
+            boards.append(bd)
+
+        entries.append({'name': name,
+                        'filename': df['filename'],
+                        'calfile': df['calfile'],
+                        'boardsfile': df['boardsfile'],
+                        'description': df['description'],
+                        'dewar': df['dewar'],
+                        'hash': df.get('hash'),
+                        'window': df.get('window'),
+                        'params': df.get('params', {}),
+                        'temperature': temperature,
+                        'boards': boards})
+
+    index = {'version': version, 'entries': entries}
+    arrays['index'] = array(json.dumps(index))
+
+    with open(fname, 'wb') as f:
+        savez_compressed(f, **arrays)
+
+
+def list_entries(fname):
+    """
+    Returns the names of the entries stored in the archive fname.
+    """
+    index = _read_index(load(fname))
+    return [entry['name'] for entry in index['entries']]
+
+
+def load_entries(fname, names=None, boards=None):
+    """
+    Read entries back from the archive fname. Returns a list of
+    (name, boardsdict) pairs, in the format of HKEModel.readfile().
+
+    names selects the entries to read (by default all of them). boards,
+    if given, is a list of board addresses whose arrays are read; the
+    other boards are still described but hold no data. The thermometer
+    board is always read, since the temperatures are recomputed from
+    it when the entry is rederived.
+
+    Entries loaded from an archive are not backed by an HKEBinaryFile,
+    so their 'file' and 'metadata' items are None.
+    """
+    archive = load(fname)
+    index = _read_index(archive)
+
+    retlist = []
+    for entry in index['entries']:
+        name = entry['name']
+        if (names is not None) and (name not in names):
+            continue
+
+        temperature = entry['temperature']
+        calTs, calRs = archive[temperature['cal']]
+        RofT = interp1d(calTs, calRs, bounds_error=False,
+                        fill_value=-1.)
+        TofR = interp1d(calRs[::-1], calTs[::-1], bounds_error=False,
+                        fill_value=-1.)
+        tdict = {'address': temperature['address'],
+                 'channel': temperature['channel'],
+                 'Ts': archive[temperature['Ts']],
+                 'TofR': TofR,
+                 'RofT': RofT}
+
+        readboards = boards
+        if (boards is not None) and (tdict['address'] is not None):
+            readboards = list(boards) + [tdict['address']]
+
+        boardsdict = {}
+        for bd in entry['boards']:
+            addr = bd['address']
+            board = {'address': addr,
+                     'type': bd['type'],
+                     'name': bd['name'],
+                     'registers': dict((reg['channel'], reg)
+                                       for reg in bd['registers'])}
+            if bd['register_name'] is not None:
+                board['register_name'] = bd['register_name']
+            if (readboards is None) or (addr in readboards):
+                for key in archived:
+                    if key in bd:
+                        board[key] = archive[bd[key]]
+                if 'data' in board:
+                    # May be shared between model entries
+                    board['data'].flags.writeable = False
+            boardsdict[addr] = board
+
+        df = {'description': entry['description'],
+              'dewar': entry['dewar'],
+              'temperature': tdict,
+              'boards': boardsdict,
+              'filename': entry['filename'],
+              'file': None,
+              'metadata': None,
+              'calfile': entry['calfile'],
+              'boardsfile': entry['boardsfile'],
+              'hash': entry['hash'],
+              'window': entry.get('window'),
+              'params': _from_json(entry.get('params', {})),
+              'archive': fname}
+        retlist.append((name, df))
+
+    return retlist
+
+
+def _from_json(value):
+    """
+    Returns value, as decoded by json, with its unicode strings (and
+    those in any nested dicts and lists) turned back into str, so that
+    the parameters compare and hash as they did when stored.
+    """
+    if isinstance(value, unicode):
+        return str(value)
+    if isinstance(value, dict):
+        return dict((_from_json(k), _from_json(v))
+                    for k, v in value.items())
+    if isinstance(value, list):
+        return [_from_json(v) for v in value]
+    return value
+
+
+def _read_index(archive):
+    index = json.loads(archive['index'][()])
+    if index['version'] > version:
+        raise ValueError("Archive version {0} is newer than the supported"
+                         " version {1}.".format(index['version'], version))
+    return index
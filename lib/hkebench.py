@@ -0,0 +1,371 @@
+"""
+Benchmarks for the data loading and processing paths of hkeplot, and
+checks of its numerical routines.
+
+Each benchmark returns a dictionary of timings (in seconds) and
+related figures, so that it can be run from a script or an interactive
+session, e.g.
+
+>>> f = HKEBinaryFile('hke_20130201_001.dat')
+>>> benchmark_extraction(f, f.list_registers())
+{'separate': 12.1, 'batched': 4.3, 'speedup': 2.8}
+
+Each check runs a routine on a small synthetic board, made by
+synthetic_board, and returns a dictionary whose 'ok' item says whether
+the result is the expected one, with the figures it was judged by.
+run_checks runs all of them.
+
+>>> run_checks()['ok']
+True
+"""
+
+import os
+import time
+from numpy import *
+from hkeio import extract_registers, spill_array
+from hkeplotmodel import HKEModel
+from hkefigures import render_state
+
+
+def best_time(func, repeat=3):
+    """
+    Returns the shortest of repeat wall clock times of calling func().
+    """
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def benchmark_extraction(hkefile, regnames, repeat=3):
+    """
+    Compare extracting the registers regnames of hkefile with one
+    get_data call per register name against a single call to
+    extract_registers. Both decode each register with get_data, so
+    extract_registers is only faster when regnames repeats names.
+    """
+    def separate():
+        for regname in regnames:
+            hkefile.get_data(regname)
+
+    def batched():
+        extract_registers(hkefile, regnames)
+
+    tseparate = best_time(separate, repeat)
+    tbatched = best_time(batched, repeat)
+    return {'separate': tseparate, 'batched': tbatched,
+            'speedup': tseparate/tbatched}
+
+
+def benchmark_archive(hkefname, calfname, archivename, bcfgfile=None,
+                      board=None):
+    """
+    Compare loading hkefname with HKEModel.loadfile against reloading
+    it from the archive archivename, and check that the round trip
+    preserves the data. If board is given, a partial reload of only
+    that board is also timed.
+    """
+    model = HKEModel()
+    start = time.time()
+    model.loadfile(hkefname, calfname, bcfgfile=bcfgfile)
+    tload = time.time() - start
+    name = model.keys()[-1]
+
+    start = time.time()
+    model.export(archivename, [name])
+    texport = time.time() - start
+
+    reloaded = HKEModel()
+    start = time.time()
+    reloaded.loadarchive(archivename)
+    treload = time.time() - start
+
+    df, df2 = model[name], reloaded[name]
+    same = array_equal(df['temperature']['Ts'], df2['temperature']['Ts'])
+    for addr, bd in df['boards'].items():
+        for key in ('data', 'Tcs'):
+            if key in bd:
+                same = same and array_equal(bd[key],
+                                            df2['boards'][addr][key])
+
+    retdict = {'loadfile': tload, 'export': texport, 'reload': treload,
+               'speedup': tload/treload, 'roundtrip': same,
+               'datasize': os.path.getsize(hkefname),
+               'archivesize': os.path.getsize(archivename)}
+
+    if board is not None:
+        partial = HKEModel()
+        start = time.time()
+        partial.loadarchive(archivename, boards=[board])
+        retdict['partial reload'] = time.time() - start
+
+    return retdict
+
+
+def synthetic_state(nlines=3, npoints=2*10**6, seed=0):
+    """
+    Returns a figure state, in the format of HKEPlotter.get_state(), of
+    nlines noisy superconducting transitions of npoints samples each.
+    """
+    random.seed(seed)
+    Ts = linspace(0.3, 1.5, npoints)
+    lines = []
+    for i in range(nlines):
+        Tc = 0.6 + 0.2*i
+        Rs = 1. + tanh((Ts - Tc)/0.005) + 0.01*random.randn(npoints)
+        lines.append({'x': Ts, 'y': Rs, 'color': 'b', 'linewidth': 1.,
+                      'linestyle': '-', 'label': 'Ch {0}'.format(i),
+                      'vlines': [(Tc, 'b', 1.)]})
+    return {'figsize': (8., 6.), 'lines': lines, 'title': 'Benchmark',
+            'xlabel': 'Temperature (K)', 'ylabel': 'Resistance (Ohm)',
+            'xscale': ('linear', {}), 'yscale': ('linear', {}),
+            'xlim': (0.3, 1.5), 'ylim': (-0.5, 2.5), 'legend': 1}
+
+
+def benchmark_vector_export(filename, state=None, dpi=300):
+    """
+    Compare the write time and file size of saving a figure state (by
+    default synthetic_state()) to the vector file filename, as is and
+    with path simplification and rasterization of dense lines.
+    """
+    if state is None:
+        state = synthetic_state()
+
+    retdict = {}
+    for key, kwargs in (('plain', {'simplify': False,
+                                   'rasterize_above': None}),
+                        ('simplified', {})):
+        start = time.time()
+        render_state(state, filename, dpi=dpi, **kwargs)
+        retdict[key + ' time'] = time.time() - start
+        retdict[key + ' size'] = os.path.getsize(filename)
+    return retdict
+
+
+def benchmark_glitches(nch=32, nsamples=10**7, window=9, nsigma=5.,
+                       chunksize=2**22, rate=1.e-4, seed=0):
+    """
+    Time HKEModel.reject_glitches on a synthetic board of nch noisy
+    channels of nsamples samples, with a fraction rate of the samples
+    replaced by large spikes, and check how many of the spikes are
+    found.
+    """
+    random.seed(seed)
+    data = random.randn(nch, nsamples)
+    spikes = zeros((nch, nsamples), dtype=bool)
+    spikes.flat[random.randint(0, nch*nsamples,
+                               int(rate*nch*nsamples))] = True
+    data[spikes] += 100.
+
+    model = HKEModel()
+    start = time.time()
+    cleaned, mask = model.reject_glitches(data, window, nsigma, chunksize)
+    seconds = time.time() - start
+
+    return {'seconds': seconds,
+            'samples/s': nch*nsamples/seconds,
+            'spikes': int(spikes.sum()),
+            'found': int((mask & spikes).sum()),
+            'rejected': int(mask.sum())}
+
+
+def synthetic_board(nch=16, nsamples=10**5, noise=.01, width=.005,
+                    seed=0):
+    """
+    Returns the data (nch, nsamples) of a synthetic board, their
+    temperatures, and the Tcs and width of its transitions. Channel i
+    has a transition at Tcs[i] of the form of HKEModel.fit_transitions
+    with R0 = 0 and Rn = 2, plus Gaussian noise of standard deviation
+    noise. The temperature sweeps from 1.5 K down to 0.3 K and back.
+    """
+    rs = random.RandomState(seed)
+    Ts = .9 + .6*cos(linspace(0., 2.*pi, nsamples))
+    Tcs = linspace(.5, 1.3, nch)
+    data = (1. + tanh((Ts - Tcs[:, newaxis])/width) +
+            noise*rs.randn(nch, nsamples))
+    return data, Ts, Tcs, width
+
+
+def check_stream_tcs(nch=16, nsamples=10**5, chunksize=2**12, seed=0):
+    """
+    Check that the Tcs streamed by HKEModel._stream_tcs, from data
+    held in a memory-mapped file and in chunks of chunksize samples,
+    are exactly those of HKEModel.find_mid_temps, with and without a
+    segment mask. The data are rounded, so that the ties between
+    samples that decide the Tc are frequent.
+    """
+    data, Ts, Tcs, width = synthetic_board(nch, nsamples, seed=seed)
+    data = around(data, 2)
+    mask = (Ts > .6) & (Ts < 1.2)
+    model = HKEModel()
+
+    expected = model.find_mid_temps(data, Ts)
+    streamed = model._compute_tcs(spill_array(data), Ts, chunksize)
+    expectedsegment = model.find_mid_temps(data[:, mask], Ts[mask])
+    streamedsegment = model._compute_tcs(data, Ts, chunksize, mask=mask)
+
+    mismatches = int((streamed != expected).sum())
+    segmentmismatches = int((streamedsegment != expectedsegment).sum())
+    return {'ok': mismatches == 0 and segmentmismatches == 0,
+            'mismatches': mismatches,
+            'segment mismatches': segmentmismatches}
+
+
+def check_glitches(nch=8, nsamples=10**5, window=9, nsigma=5.,
+                   chunksize=2**14, rate=1.e-3, seed=0):
+    """
+    Check HKEModel.reject_glitches on a synthetic board with isolated
+    spikes of 100 noise standard deviations added: every spike must
+    be rejected and at most one in 10**4 other samples, rejected
+    samples must be replaced by the median of their neighbours and
+    the others left alone, and data held in a memory-mapped file must
+    give the same result as in memory.
+    """
+    data, Ts, Tcs, width = synthetic_board(nch, nsamples, seed=seed)
+    rs = random.RandomState(seed + 1)
+    nspikes = int(rate*nch*nsamples)
+    # At most one spike per window, so the median is not disturbed
+    positions = rs.randint(0, nsamples//window, nspikes)*window + window//2
+    spikes = zeros(data.shape, dtype=bool)
+    spikes[rs.randint(0, nch, nspikes), positions] = True
+    spiked = data + 1.*spikes
+
+    model = HKEModel()
+    cleaned, mask = model.reject_glitches(spiked, window, nsigma,
+                                          chunksize)
+    mcleaned, mmask = model.reject_glitches(spill_array(spiked), window,
+                                            nsigma, chunksize)
+    running = model.running_median(spiked, window, center=False)
+
+    missed = int((spikes & ~mask).sum())
+    false = int((mask & ~spikes).sum())
+    replaced = array_equal(cleaned[mask], running[mask])
+    kept = array_equal(cleaned[~mask], spiked[~mask])
+    mapped = array_equal(mask, mmask) and array_equal(cleaned, mcleaned)
+    return {'ok': (missed == 0 and false <= 1.e-4*data.size and
+                   replaced and kept and mapped),
+            'spikes': int(spikes.sum()), 'missed': missed,
+            'false': false, 'replaced': replaced, 'kept': kept,
+            'mapped': mapped}
+
+
+def check_bin_data(nch=4, nsamples=10**4, nbins=50, chunksize=2**10,
+                   seed=0):
+    """
+    Check the means, standard deviations and counts of
+    HKEModel._bin_data, binned a chunk of chunksize samples at a time,
+    against binning every channel one bin at a time. As with
+    numpy.digitize, each bin holds its lower edge, and the last bin
+    also its upper edge.
+    """
+    data, Ts, Tcs, width = synthetic_board(nch, nsamples, seed=seed)
+    edges = linspace(.4, 1.4, nbins + 1)
+    mean, std, count = HKEModel()._bin_data(data, Ts, edges, chunksize)
+
+    expectedcount = zeros(nbins, dtype=int)
+    expectedmean = empty((nch, nbins))
+    expectedmean.fill(nan)
+    expectedstd = expectedmean.copy()
+    for b in range(nbins):
+        inbin = (Ts >= edges[b]) & (Ts < edges[b+1])
+        if b == nbins - 1:
+            inbin |= Ts == edges[-1]
+        expectedcount[b] = inbin.sum()
+        if expectedcount[b]:
+            expectedmean[:, b] = data[:, inbin].mean(axis=-1)
+            expectedstd[:, b] = data[:, inbin].std(axis=-1)
+
+    filled = expectedcount > 0
+    counts = array_equal(count, expectedcount)
+    blank = (isnan(mean[:, ~filled]).all() and
+              isnan(std[:, ~filled]).all())
+    means = allclose(mean[:, filled], expectedmean[:, filled],
+                     rtol=1.e-10, atol=1.e-12)
+    stds = allclose(std[:, filled], expectedstd[:, filled],
+                    rtol=1.e-8, atol=1.e-12)
+    return {'ok': counts and blank and means and stds,
+            'counts': counts, 'empty bins': blank, 'means': means,
+            'stds': stds}
+
+
+def check_fit(nch=16, nsamples=10**5, nbins=400, seed=0):
+    """
+    Check that HKEModel.fit_transitions recovers the Tcs and width of
+    the transitions of a synthetic board to within a tenth of a bin,
+    with residuals below the noise of the samples.
+    """
+    noise = .01
+    data, Ts, Tcs, width = synthetic_board(nch, nsamples, noise,
+                                           seed=seed)
+    fitTcs, widths, residuals = HKEModel().fit_transitions(
+        data, Ts, nbins, chunksize=2**14)
+    binwidth = (Ts.max() - Ts.min())/nbins
+
+    Tcerror = abs(fitTcs - Tcs).max()
+    widtherror = abs(widths - width).max()
+    return {'ok': (Tcerror < .1*binwidth and widtherror < .1*binwidth and
+                   residuals.max() < noise),
+            'Tc error': Tcerror, 'width error': widtherror,
+            'residual': residuals.max(), 'bin width': binwidth}
+
+
+def check_transitions(nch=8, nsamples=10**5, nbins=400, seed=0):
+    """
+    Check that HKEModel.transitions finds the two transitions of every
+    channel of a synthetic board, each within two bins of where it
+    was put, and no others.
+    """
+    noise, width = .01, .005
+    rs = random.RandomState(seed)
+    Ts = .9 + .6*cos(linspace(0., 2.*pi, nsamples))
+    low = linspace(.5, .8, nch)
+    high = low + .4
+    data = (2. + tanh((Ts - low[:, newaxis])/width) +
+            tanh((Ts - high[:, newaxis])/width) +
+            noise*rs.randn(nch, nsamples))
+
+    model = HKEModel()
+    name = _synthetic_entry(model, data, Ts)
+    grid = (Ts.min(), Ts.max(), nbins)
+    found = model.transitions(name, 0, grid)
+    binwidth = (Ts.max() - Ts.min())/nbins
+
+    counts = bincount(found['channel'], minlength=nch)
+    ok = bool((counts == 2).all())
+    error = nan
+    if ok:
+        # Sorted by channel and temperature, so in pairs (low, high)
+        expected = column_stack((low, high)).ravel()
+        error = abs(found['T'] - expected).max()
+        ok = error < 2.*binwidth
+    return {'ok': ok, 'transitions': int(len(found['channel'])),
+            'error': error, 'bin width': binwidth}
+
+
+def _synthetic_entry(model, data, Ts, name='synthetic', address=0):
+    """
+    Add a model item holding only data, as board address, and their
+    temperatures, for checking the methods that take model items.
+    Returns its name.
+    """
+    name = model.unique_name(name)
+    model.datafiles[name] = {'boards': {address: {'data': data}},
+                             'temperature': {'Ts': Ts}}
+    model.orderedkeys.append(name)
+    return name
+
+
+def run_checks(seed=0):
+    """
+    Run all the checks of the numerical routines. Returns a dictionary
+    of their results by name, and 'ok', whether all of them passed.
+    """
+    results = {'stream_tcs': check_stream_tcs(seed=seed),
+               'glitches': check_glitches(seed=seed),
+               'bin_data': check_bin_data(seed=seed),
+               'fit': check_fit(seed=seed),
+               'transitions': check_transitions(seed=seed)}
+    results['ok'] = all([r['ok'] for r in results.values()])
+    return results
@@ -0,0 +1,177 @@
+"""
+Bootstrap estimates of the uncertainties of Tcs, computed in a pool of
+worker processes.
+
+Every bootstrap replicate draws the samples of a board with
+replacement and recomputes the Tc of all of its channels at once, with
+the same estimator as the Tcs themselves. Replicate i always uses the
+random seed seed + i, so the result does not depend on the number of
+processes or on how the replicates are batched.
+
+The worker pool is started on first use and reused by later calls, see
+get_pool. The data of a board are written once to temporary files,
+which the workers memory-map.
+
+Example usage:
+
+>>> board = hkem['hke_20130201_001.dat']['boards'][8]
+>>> Ts = hkem['hke_20130201_001.dat']['temperature']['Ts']
+>>> errors = bootstrap_tcs(board['data'], Ts, nresamples=200)
+"""
+
+import os
+import shutil
+import tempfile
+import multiprocessing
+from numpy import *
+
+
+def bootstrap_tcs(data, Ts, nresamples=200, seed=0, method='midpoint',
+                  midfraction=.5, nbins=400, processes=None, batch=10,
+                  samples=None, callback=None):
+    """
+    Returns the bootstrap standard deviation of the Tc of every
+    channel (row) of data, from nresamples replicates. method is the
+    Tc estimator, 'midpoint' (see HKEModel.find_mid_temps, with
+    midfraction) or 'fit' (see HKEModel.fit_transitions, with nbins).
+    If samples, an array of sample indices, is given, the replicates
+    are drawn from those samples only.
+
+    The replicates are computed in batches of batch by the pool of
+    processes worker processes (by default one per CPU) returned by
+    get_pool. With processes=1 they are computed in this process
+    instead.
+
+    If given, callback is called as callback(n) after each batch, with
+    the number n of replicates done. If it raises, e.g. to cancel the
+    computation, the pool is terminated and the exception passed on.
+    """
+    if method not in ('midpoint', 'fit'):
+        raise ValueError("Unknown Tc method '{0}'.".format(method))
+    tcparams = {'method': method, 'midfraction': midfraction,
+                'nbins': nbins}
+    seeds = [seed + i for i in range(int(nresamples))]
+    batches = [seeds[i:i+batch] for i in range(0, len(seeds), batch)]
+
+    results = []
+    done = 0
+    if processes == 1:
+        _worker.clear()
+        _worker.update({'source': None, 'data': asarray(data),
+                        'Ts': asarray(Ts), 'samples': samples})
+        for seeds in batches:
+            results.append(_bootstrap_batch((None, tcparams, seeds)))
+            done += len(seeds)
+            if callback is not None:
+                callback(done)
+        _worker.clear()
+        return concatenate(results).std(axis=0, ddof=1)
+
+    folder = tempfile.mkdtemp(prefix='hkebootstrap')
+    try:
+        save(os.path.join(folder, 'data.npy'), data)
+        save(os.path.join(folder, 'Ts.npy'), Ts)
+        if samples is not None:
+            save(os.path.join(folder, 'samples.npy'), samples)
+        tasks = [(folder, tcparams, seeds) for seeds in batches]
+        pool = get_pool(processes)
+        try:
+            for tcs in pool.imap(_bootstrap_batch, tasks):
+                results.append(tcs)
+                done += len(tcs)
+                if callback is not None:
+                    callback(done)
+        except Exception:
+            # The remaining batches are abandoned with the pool
+            _discard_pool(processes)
+            raise
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    return concatenate(results).std(axis=0, ddof=1)
+
+
+# The worker pools, by number of processes, see get_pool
+_pools = {}
+
+
+def get_pool(processes=None):
+    """
+    Returns the pool of processes worker processes (by default one per
+    CPU) used by bootstrap_tcs, starting it on first use.
+    """
+    if processes not in _pools:
+        _pools[processes] = multiprocessing.Pool(processes)
+    return _pools[processes]
+
+
+def close_pools():
+    """
+    Wait for the worker pools started by get_pool to finish and shut
+    them down.
+    """
+    for pool in _pools.values():
+        pool.close()
+        pool.join()
+    _pools.clear()
+
+
+def _discard_pool(processes):
+    pool = _pools.pop(processes, None)
+    if pool is not None:
+        pool.terminate()
+        pool.join()
+
+
+# The data of the board being resampled, loaded once per worker
+# process and board
+_worker = {}
+
+
+def _load_source(folder):
+    """
+    Memory-map the data written to folder by bootstrap_tcs.
+    """
+    samplesname = os.path.join(folder, 'samples.npy')
+    _worker['source'] = folder
+    _worker['data'] = load(os.path.join(folder, 'data.npy'),
+                           mmap_mode='r')
+    _worker['Ts'] = load(os.path.join(folder, 'Ts.npy'), mmap_mode='r')
+    _worker['samples'] = None
+    if os.path.exists(samplesname):
+        _worker['samples'] = load(samplesname)
+
+
+def _bootstrap_batch(task):
+    """
+    Returns the Tcs of every channel for the replicates with the
+    given seeds, as an array of shape (len(seeds), nchannels). task is
+    (source, tcparams, seeds), where source is the folder holding the
+    data, or None for the data already set in this process.
+    """
+    source, tcparams, seeds = task
+    if (source is not None) and (_worker.get('source') != source):
+        _load_source(source)
+    if 'model' not in _worker:
+        # Imported here to avoid a circular import
+        from hkeplotmodel import HKEModel
+        _worker['model'] = HKEModel()
+
+    data = _worker['data']
+    Ts = _worker['Ts']
+    model = _worker['model']
+    samples = _worker['samples']
+    nsamples = len(Ts) if samples is None else len(samples)
+
+    tcs = empty((len(seeds), len(data)))
+    for k, seed in enumerate(seeds):
+        index = random.RandomState(seed).randint(0, nsamples, nsamples)
+        if samples is not None:
+            index = samples[index]
+        if tcparams['method'] == 'fit':
+            tcs[k] = model.fit_transitions(data[:, index], Ts[index],
+                                           tcparams['nbins'])[0]
+        else:
+            tcs[k] = model.find_mid_temps(data[:, index], Ts[index],
+                                          tcparams['midfraction'])
+    return tcs
@@ -0,0 +1,82 @@
+"""
+Comparison of channels from any loaded data files on a shared
+temperature axis.
+
+Every channel is resampled onto the same temperatures with
+HKEModel.resampled, which caches the result in the model, so a file is
+interpolated only once per temperature grid however many of its
+channels are compared, and curves can be redrawn without
+re-interpolating. Channels are specified as (name, address, channel)
+tuples, where name is the key of the model item.
+
+Example usage:
+
+>>> comp = HKEComparison(hkem)
+>>> a = ('hke_20130201_001.dat', 8, 3)
+>>> b = ('hke_20130207_009.dat', 8, 3)
+>>> grid = comp.common_grid([a, b], npoints=2000)
+>>> Ts, dR = comp.difference(a, b, grid)
+"""
+
+from numpy import *
+from hkeplotmodel import HKEPlotError
+
+
+class HKEComparison(object):
+    """
+    Resamples channels of an HKEModel onto a common temperature axis,
+    and computes difference and ratio curves between them.
+    """
+    def __init__(self, model):
+        self.model = model
+
+    def temperature_range(self, name):
+        """
+        Returns the lowest and highest valid temperature of model item
+        name, see HKEModel.temperature_range.
+        """
+        return self.model.temperature_range(name)
+
+    def common_grid(self, channels, npoints=2000):
+        """
+        Returns the grid, (Tmin, Tmax, npoints), spanning the
+        temperature range covered by all of channels.
+        """
+        names = set(name for name, address, channel in channels)
+        ranges = [self.temperature_range(name) for name in names]
+        Tmin = array([r[0] for r in ranges]).max()
+        Tmax = array([r[1] for r in ranges]).min()
+        if Tmin >= Tmax:
+            raise HKEPlotError("The temperature ranges of the compared "
+                               "files do not overlap.")
+        return (Tmin, Tmax, npoints)
+
+    def curve(self, channel, grid):
+        """
+        Returns the temperatures of grid and the resistances of channel
+        resampled onto them. See HKEModel.resampled for the format of
+        grid.
+        """
+        name, address, ch = channel
+        resampled = self.model.resampled(name, address, grid)
+        return resampled['Ts'], resampled['data'][ch]
+
+    def difference(self, channel, reference, grid):
+        """
+        Returns the temperatures of grid and the resistance of channel
+        minus that of reference at each of them.
+        """
+        Ts, Rs = self.curve(channel, grid)
+        Ts, Rref = self.curve(reference, grid)
+        return Ts, Rs - Rref
+
+    def ratio(self, channel, reference, grid):
+        """
+        Returns the temperatures of grid and the resistance of channel
+        divided by that of reference at each of them. Points where the
+        reference is zero are inf or NaN.
+        """
+        Ts, Rs = self.curve(channel, grid)
+        Ts, Rref = self.curve(reference, grid)
+        with errstate(divide='ignore', invalid='ignore'):
+            return Ts, Rs/Rref
@@ -119,8 +119,7 @@ class HKEConfig(object):
         config = ConfigParser.RawConfigParser()
         config.read(configfname)
 
-        f = filedict['file']
-        absname = os.path.abspath(f.filename)
+        absname = os.path.abspath(filedict['filename'])
         shortname = os.path.basename(absname)
         if name is None:
             name = shortname
@@ -0,0 +1,245 @@
+"""
+Rendering of stored figures to disk in background worker processes.
+
+A figure is stored as the picklable state returned by
+HKEPlotter.get_state(), and rendered by render_state() in a worker
+process on the non-interactive backend matching the output format
+(Agg for PNG, PDF, SVG or PS), so the GUI is not blocked while large
+figures are written.
+
+Example usage:
+
+>>> exporter = FigureExporter()
+>>> exporter.submit(plotter.get_state(), 'run7.png')
+>>> exporter.submit(plotter.get_state(), 'run7.pdf')
+>>> exporter.status()
+{'done': 1, 'failed': 0, 'pending': 1, 'errors': []}
+"""
+
+import os
+import multiprocessing
+from numpy import *
+from matplotlib.figure import Figure
+from matplotlib.ticker import MaxNLocator, FuncFormatter
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.backends.backend_pdf import FigureCanvasPdf
+from matplotlib.backends.backend_svg import FigureCanvasSVG
+from matplotlib.backends.backend_ps import FigureCanvasPS
+
+
+canvases = {'.png': FigureCanvasAgg,
+            '.pdf': FigureCanvasPdf,
+            '.svg': FigureCanvasSVG,
+            '.eps': FigureCanvasPS,
+            '.ps': FigureCanvasPS}
+
+vectorformats = ('.pdf', '.svg', '.eps', '.ps')
+
+# The markers of the Tcs drawn over a heatmap
+tcmarkers = {'s': 9, 'c': 'w', 'edgecolors': 'k', 'linewidths': .5,
+             'zorder': 3}
+
+
+def render_state(state, filename, dpi=300, simplify=True, tolerance=1.,
+                 rasterize_above=50000):
+    """
+    Redraw the figure described by state, as returned by
+    HKEPlotter.get_state(), and save it to filename. The format, and
+    the backend used, are chosen by the extension of filename.
+    Returns filename.
+
+    For vector formats, lines of more than rasterize_above samples
+    are rasterized at dpi, while the axes and text stay vector. Pass
+    None to never rasterize. The decision is made on the samples of
+    the line, before any simplification: simplifying bounds the
+    points of a line by the width of the axes in pixels, whatever
+    the density of its data. If simplify is True, each line is also
+    reduced to the samples that are distinguishable at dpi: within
+    every run of samples falling in the same tolerance-pixel wide
+    column, only the first, last, lowest and highest are kept.
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    fig = Figure(figsize=state['figsize'], dpi=dpi)
+    canvases[ext](fig)
+    axes = fig.add_subplot(111)
+
+    # Scales and limits first, so the data transform is final when
+    # the lines are simplified
+    xscale, xkwargs = state['xscale']
+    yscale, ykwargs = state['yscale']
+    axes.set_xscale(xscale, **xkwargs)
+    axes.set_yscale(yscale, **ykwargs)
+    axes.set_autoscale_on(False)
+    axes.set_xlim(state['xlim'])
+    axes.set_ylim(state['ylim'])
+
+    heatmap = state.get('heatmap')
+    if heatmap is not None:
+        draw_heatmap(axes, heatmap['image'], heatmap['edges'],
+                     heatmap['cmap'], heatmap['clim'])
+        label_rows(axes, heatmap['rowlabels'])
+        x, y = heatmap['Tcs']
+        if len(x):
+            axes.scatter(x, y, **tcmarkers)
+        # Drawing the image resets the limits
+        axes.set_xlim(state['xlim'])
+        axes.set_ylim(state['ylim'])
+
+    vector = ext in vectorformats
+    for ld in state['lines']:
+        x, y = ld['x'], ld['y']
+        rasterize = (vector and (rasterize_above is not None) and
+                     (len(x) > rasterize_above))
+        if vector and simplify:
+            keep = simplify_line(axes, x, y, tolerance)
+            x, y = x[keep], y[keep]
+        line, = axes.plot(x, y, color=ld['color'],
+                          linewidth=ld['linewidth'],
+                          linestyle=ld['linestyle'], label=ld['label'])
+        if rasterize:
+            line.set_rasterized(True)
+        for x, color, lw in ld['vlines']:
+            axes.axvline(x, color=color, linewidth=lw, ls='--')
+        for x, color, lw in ld.get('tlines', []):
+            axes.axvline(x, color=color, linewidth=lw, ls=':')
+
+    axes.set_title(state['title'])
+    axes.set_xlabel(state['xlabel'])
+    axes.set_ylabel(state['ylabel'])
+    if state['legend'] is not None:
+        axes.legend(loc=state['legend'])
+
+    fig.savefig(filename, dpi=dpi)
+    return filename
+
+
+def draw_heatmap(axes, image, edges, cmap=None, clim=None):
+    """
+    Draw image, of shape (nrows, len(edges) - 1), on axes as a single
+    artist, with row i centred on y = i and its columns spanning the
+    temperature bins between edges. Uniform grids are drawn with
+    imshow, others with pcolormesh. NaNs are left blank. Returns the
+    artist.
+    """
+    image = ma.masked_invalid(image)
+    nrows = image.shape[0]
+    widths = diff(edges)
+    if allclose(widths, widths[0]):
+        artist = axes.imshow(image, aspect='auto', origin='lower',
+                             interpolation='nearest', cmap=cmap,
+                             extent=(edges[0], edges[-1],
+                                     -.5, nrows - .5))
+    else:
+        artist = axes.pcolormesh(edges, arange(nrows + 1) - .5, image,
+                                 cmap=cmap)
+    if clim is not None:
+        artist.set_clim(clim)
+    return artist
+
+
+def label_rows(axes, labels):
+    """
+    Label the y axis of a heatmap drawn by draw_heatmap with labels,
+    one per row. Ticks are only put on whole rows, and thinned out
+    when there are too many rows to label them all.
+    """
+    def formatter(y, pos):
+        i = int(round(y))
+        if (0 <= i < len(labels)) and (abs(y - i) < 1.e-6):
+            return labels[i]
+        return ''
+
+    axes.yaxis.set_major_locator(MaxNLocator(nbins=20, integer=True))
+    axes.yaxis.set_major_formatter(FuncFormatter(formatter))
+
+
+def simplify_line(axes, x, y, tolerance=1.):
+    """
+    Returns the indices of the samples of the line (x, y) that are
+    needed to draw it on axes to within tolerance pixels, in the
+    order of the samples.
+
+    Consecutive samples falling in the same tolerance-pixel wide
+    column are merged into the first, last, lowest and highest of
+    them. Samples that cannot be drawn (NaN, or nonpositive on log
+    axes) are dropped.
+    """
+    xy = axes.transData.transform(column_stack((x, y)))
+    finite = nonzero(isfinite(xy).all(axis=1))[0]
+    if not len(finite):
+        return finite
+    px, py = xy[finite, 0], xy[finite, 1]
+
+    # Runs of consecutive samples in the same pixel column
+    columns = floor(px/tolerance)
+    starts = concatenate(([0], nonzero(diff(columns))[0] + 1))
+    runs = zeros(len(px), dtype=int)
+    runs[starts[1:]] = 1
+    runs = cumsum(runs)
+    ends = concatenate((starts[1:] - 1, [len(px) - 1]))
+
+    # Sorting by run, then height, puts the lowest sample of each run
+    # at its start and the highest at its end
+    byheight = lexsort((py, runs))
+    lowest = byheight[starts]
+    highest = byheight[ends]
+
+    keep = unique(concatenate((starts, ends, lowest, highest)))
+    return finite[keep]
+
+
+class FigureExporter(object):
+    """
+    A queue of figures to be rendered to disk by a pool of worker
+    processes.
+    """
+    def __init__(self, processes=None):
+        self.processes = processes
+        self.pool = None
+        self.jobs = []
+
+    def submit(self, state, filename, dpi=300, **kwargs):
+        """
+        Queue the figure described by state to be saved to filename.
+        kwargs are passed on to render_state().
+        """
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.processes)
+        job = self.pool.apply_async(render_state, (state, filename, dpi),
+                                    kwargs)
+        self.jobs.append((filename, job))
+
+    def status(self):
+        """
+        Returns a dictionary of the numbers of 'done', 'failed' and
+        'pending' jobs, and the 'errors' of the failed ones as
+        (filename, message) pairs.
+        """
+        retdict = {'done': 0, 'failed': 0, 'pending': 0, 'errors': []}
+        for filename, job in self.jobs:
+            if not job.ready():
+                retdict['pending'] += 1
+            elif job.successful():
+                retdict['done'] += 1
+            else:
+                retdict['failed'] += 1
+                try:
+                    job.get()
+                except Exception as e:
+                    retdict['errors'].append((filename, str(e)))
+        return retdict
+
+    def clear(self):
+        """
+        Forget the finished jobs.
+        """
+        self.jobs = [(f, job) for f, job in self.jobs if not job.ready()]
+
+    def close(self):
+        """
+        Wait for the queued jobs to finish and shut down the workers.
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
@@ -0,0 +1,125 @@
+"""
+Functions for extracting register data from HKEBinaryFile files.
+
+Example usage:
+
+>>> f = HKEBinaryFile('hke_20130201_001.dat')
+>>> names = ['SHINY_T3 (8-TRead_LR): Demod', 'SHINY_T3 (8-TRead_LR): ADac']
+>>> data = extract_registers(f, names)
+>>> data['SHINY_T3 (8-TRead_LR): Demod'].shape
+(123456, 32)
+"""
+
+from numpy import *
+from tempfile import TemporaryFile
+
+
+def extract_registers(hkefile, regnames, out=None, callback=None,
+                      spill=None, metadata=None):
+    """
+    Extract the data of several registers of hkefile, and return a
+    dictionary mapping each register name to its (nsamples,
+    nchannels) data array.
+
+    HKEBinaryFile only decodes one register at a time, so each
+    register is still read with its own get_data call. Duplicate
+    names are decoded only once, and the registers are visited in the
+    order in which they are stored in the file. An unknown register
+    name raises HKEPlotError before anything is decoded. If out
+    is given, it is a dictionary of preallocated arrays, keyed by
+    register name, that the data of those registers are written into
+    instead of new arrays being allocated (see allocate_registers).
+
+    callback, if given, is called as callback(regname) before each
+    register is decoded. Any exception it raises aborts the
+    extraction.
+
+    If spill is given, the data of registers not in out are moved to
+    memory-mapped temporary files as soon as they are decoded, so
+    that only one register is held in memory at a time. See
+    spill_array. If the HKEMetadata object metadata is given as well,
+    the shape of each register is recorded in it as it is decoded, and
+    once the number of samples is known the remaining registers are
+    preallocated as memory-mapped files (see allocate_registers) and
+    written into directly.
+    """
+    out = dict(out or {})
+
+    order = dict((regname, i)
+                 for i, regname in enumerate(hkefile.list_registers()))
+    unique = []
+    for regname in regnames:
+        if regname not in order:
+            # Imported here to avoid a circular import
+            from hkeplotmodel import HKEPlotError
+            raise HKEPlotError("{0} has no register "
+                               "'{1}'.".format(hkefile.filename, regname))
+        if regname not in unique:
+            unique.append(regname)
+    unique.sort(key=lambda regname: order[regname])
+
+    retdict = {}
+    for regname in unique:
+        if callback is not None:
+            callback(regname)
+        data = hkefile.get_data(regname)
+        if regname in out:
+            dest = out[regname]
+            dest[...] = data.reshape(dest.shape)
+            data = dest
+        elif spill is not None:
+            data = spill_array(data, spill)
+        retdict[regname] = data
+        if metadata is not None:
+            metadata.set_shape(regname, data.shape)
+            if spill is not None:
+                rest = [name for name in unique
+                        if name not in retdict and name not in out]
+                out.update(allocate_registers(metadata, rest, spill=spill))
+
+    return retdict
+
+
+def allocate_registers(metadata, regnames, dtype=float64, spill=None):
+    """
+    Preallocate output arrays for extract_registers from the shapes
+    recorded in an HKEMetadata object. Registers whose shape is not
+    yet known are left out, and are allocated by extract_registers
+    instead.
+
+    If spill is given, the arrays are memory-mapped temporary files in
+    the folder spill (or in the default temporary folder if spill is
+    True) rather than held in memory. The files are deleted when the
+    arrays are.
+    """
+    out = {}
+    nsamples = metadata.nsamples
+    if nsamples is None:
+        return out
+    for regname in regnames:
+        nch = metadata.nchannels(regname, decode=False)
+        if nch is None:
+            continue
+        if spill is None:
+            out[regname] = empty((nsamples, nch), dtype=dtype)
+        else:
+            out[regname] = _temporary_memmap((nsamples, nch), dtype,
+                                             spill)
+    return out
+
+
+def spill_array(data, spill=True):
+    """
+    Returns a copy of data in a memory-mapped temporary file in the
+    folder spill (or in the default temporary folder if spill is
+    True). The file is deleted when the copy is.
+    """
+    dest = _temporary_memmap(data.shape, data.dtype, spill)
+    dest[...] = data
+    return dest
+
+
+def _temporary_memmap(shape, dtype, spill):
+    folder = None if spill is True else spill
+    return memmap(TemporaryFile(dir=folder), dtype=dtype, mode='w+',
+                  shape=shape)
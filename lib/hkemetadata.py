@@ -0,0 +1,114 @@
+"""
+The HKEMetadata class caches the header information of an
+HKEBinaryFile, i.e. the register names, channel counts, channel tags
+and sample counts, so that dialogs and listboxes can look them up
+without decoding any data.
+
+Example usage:
+
+>>> f = HKEBinaryFile('hke_20130201_001.dat')
+>>> md = HKEMetadata(f)
+>>> md.registers[0]
+'ADR Root coil (1-DSPID): Demod'
+>>> md.nchannels('ADR Root coil (1-DSPID): Demod')
+1
+"""
+
+import re
+
+
+class HKEMetadata(object):
+    """
+    A cache of the header information of an HKEBinaryFile.
+
+    Registers may be specified either by name or by their index in
+    HKEMetadata.registers, which is the same ordering used by
+    HKEBinaryFile.list_registers() and HKEBinaryFile.get_data().
+    """
+    # Register names are formatted as "{name} ({addr}-{btype}): {rtype}",
+    # see parseboards.construct_register_name
+    regpattern = re.compile(r'^(?P<name>.*) \((?P<address>\d+)-'
+                            r'(?P<type>\w+)\): (?P<rtype>.*)$')
+
+    def __init__(self, hkefile):
+        self.file = hkefile
+        self.filename = hkefile.filename
+        self.registers = list(hkefile.list_registers())
+
+        # Number of samples per channel. Every register in a file holds
+        # the same number of samples, but this is not known until some
+        # register has been decoded.
+        self.nsamples = None
+
+        self.info = {}
+        self._parse_header()
+
+    def _parse_header(self):
+        """
+        Fill in self.info with the per-register header information.
+        """
+        boards = {}
+        for bd in self.file.header.boarddescriptions:
+            boards[bd.address] = bd
+
+        for regname in self.registers:
+            info = {'address': None, 'board': None, 'type': None,
+                    'rtype': None, 'chtags': None, 'nchannels': None}
+            match = self.regpattern.match(regname)
+            if match:
+                address = int(match.group('address'))
+                info['address'] = address
+                info['board'] = match.group('name')
+                info['type'] = match.group('type').lower()
+                info['rtype'] = match.group('rtype')
+                try:
+                    reg = boards[address].registers[info['rtype']]
+                    info['chtags'] = list(reg.chtags)
+                    info['nchannels'] = len(info['chtags'])
+                except (KeyError, AttributeError):
+                    pass
+            self.info[regname] = info
+
+    def register_name(self, register):
+        """
+        Returns the name of the specified register.
+        """
+        if isinstance(register, int):
+            return self.registers[register]
+        return register
+
+    def register_info(self, register):
+        """
+        Returns the dictionary of header information of the specified
+        register.
+        """
+        return self.info[self.register_name(register)]
+
+    def chtags(self, register):
+        """
+        Returns the list of channel tags of the specified register, or
+        None if the header does not list them.
+        """
+        return self.register_info(register)['chtags']
+
+    def nchannels(self, register, decode=True):
+        """
+        Returns the number of channels in the specified register.
+
+        If the header does not describe the register and decode is
+        True, the register is decoded once to find out and the result
+        is cached. Otherwise None is returned.
+        """
+        info = self.register_info(register)
+        if info['nchannels'] is None and decode:
+            data = self.file.get_data(self.register_name(register))
+            self.set_shape(register, data.shape)
+        return info['nchannels']
+
+    def set_shape(self, register, shape):
+        """
+        Record the shape, (nsamples, nchannels), of a decoded register.
+        """
+        info = self.register_info(register)
+        info['nchannels'] = shape[-1] if len(shape) > 1 else 1
+        self.nsamples = shape[0]
@@ -90,10 +90,15 @@ class MainFrame(wx.Frame):
     def add_graphframe(self, graphframe):
         self.graphframe = graphframe
         self.notebook.plotpanel.graphframe = graphframe
+        graphframe.plotter = self.plotter
 
     def onClose(self, event):
         # self.save_config()
 
+        # Let figures still being saved finish
+        self.notebook.plotpanel.exporttimer.Stop()
+        self.notebook.plotpanel.exporter.close()
+
         self.graphframe.Destroy()
         self.Destroy()
 
@@ -14,11 +14,18 @@ Example usage:
 from HKEBinaryFile import HKEBinaryFile as BinaryFile
 from HKEBinaryFile import HKEInvalidRegisterError
 from hkeconfig import HKEConfig
+from hkemetadata import HKEMetadata
+from hkeio import extract_registers, spill_array
+from hkebootstrap import bootstrap_tcs
+import hkearchive
 from parseboards import parse_boards_file, construct_register_name, \
                         save_board_file
 from scipy.interpolate import interp1d
 from numpy import *
+from numpy.lib.stride_tricks import as_strided
 import os
+import threading
+import hashlib
 from tempfile import TemporaryFile
 from collections import Iterable
 from types import StringTypes
@@ -48,11 +55,63 @@ class HKEModel(object):
 
     will not work.
     """
+    # The processing pipeline of a loaded data file: the stages in the
+    # order in which they must be computed, whether each is computed
+    # per 'board' or once per 'entry', and the stages it takes as
+    # inputs. Each stage is computed by the HKEModel._stage_<name>
+    # method, except 'decode', whose output is the board data read by
+    # readfile(). See HKEModel.run_pipeline.
+    stages = [('decode', 'board', ()),
+              ('calibrate', 'entry', ('decode',)),
+              ('filter', 'board', ('decode',)),
+              ('Trange', 'entry', ('calibrate',)),
+              ('segment', 'entry', ('calibrate',)),
+              ('Tc', 'board', ('filter', 'calibrate', 'segment')),
+              ('Tcerror', 'board', ('filter', 'calibrate', 'segment',
+                                    'Tc')),
+              ('summary', 'board', ('filter', 'calibrate', 'Tc')),
+              ('binned', 'entry', ('decode', 'calibrate')),
+              ('resampled', 'entry', ('decode', 'calibrate'))]
+
+    # Where the output of each stage is stored, in the board
+    # dictionary for board stages and in the entry otherwise. Stages
+    # with several outputs return a tuple of them.
+    outputs = {'decode': 'data', 'calibrate': 'Ts', 'filter': 'filtered',
+               'segment': 'segment', 'Trange': 'Trange',
+               'Tc': ('Tcs', 'Tcwidths', 'Tcresiduals'),
+               'Tcerror': 'Tcerrors', 'summary': 'summary',
+               'binned': 'binned', 'resampled': 'resampled'}
+
+    # The default parameters of the stages, see HKEModel.set_params
+    defaults = {'filter': {'method': 'none', 'window': 9, 'nsigma': 5.},
+                'segment': {'method': 'all'},
+                'Tc': {'method': 'midpoint', 'midfraction': .5,
+                       'nbins': 400},
+                'Tcerror': {'method': 'none', 'nresamples': 200,
+                            'seed': 0},
+                'summary': {'normalfraction': .1}}
+
+    # The fields of the per-channel summaries, see HKEModel.summary
+    summarydtype = [('channel', int), ('minR', float64),
+                    ('maxR', float64), ('normalR', float64),
+                    ('noise', float64), ('Tc', float64),
+                    ('nsamples', int)]
+
     def __init__(self, datafiles=None, calfiles=None, boardscfgfiles=None,
                  taddresses=None, tchannels=None):
         self.datafiles = {}
         self.orderedkeys = []
 
+        # Decoded register data shared between the entries loaded from
+        # identical files, keyed by the hash of the file contents. See
+        # HKEModel.add_datafile.
+        self._shared = {}
+        self._hashes = {}
+
+        # Stage outputs, keyed by the hash of the stage, its parameters
+        # and its inputs. See HKEModel.run_pipeline.
+        self._memo = {}
+
         if datafiles is None:
             return
 
@@ -82,8 +141,91 @@ class HKEModel(object):
                 print ex
                 raise ex
 
-    def loadfile(self, hkefname, calfname, #taddress=None, tchannel=None,
-                 bcfgfile=None, description=None, handleerrors=True):
+    def loadfile(self, hkefname, calfname, bcfgfile=None,
+                 description=None, handleerrors=True, progress=None,
+                 cancel=None, taddress=None, tchannel=None, spill=None,
+                 window=None, chunksize=2**22, params=None):
+        """
+        Read and process a data file and add it to the model.
+
+        See readfile() for the meaning of the arguments. If the load
+        is cancelled, HKEPlotLoadCancelledError is raised and the
+        model is left unchanged.
+        """
+        name, boardsdict = self.readfile(hkefname, calfname,
+                                         bcfgfile=bcfgfile,
+                                         description=description,
+                                         handleerrors=handleerrors,
+                                         progress=progress,
+                                         cancel=cancel,
+                                         taddress=taddress,
+                                         tchannel=tchannel,
+                                         chunksize=chunksize,
+                                         spill=spill, window=window,
+                                         params=params)
+        self.add_datafile(name, boardsdict)
+
+        return True
+
+    def readfile(self, hkefname, calfname, bcfgfile=None,
+                 description=None, handleerrors=True, progress=None,
+                 cancel=None, taddress=None, tchannel=None,
+                 chunksize=2**22, spill=None, window=None, params=None):
+        """
+        Read and process a data file without adding it to the model.
+        Returns the name the file would be stored under and its data
+        dictionary, which may be handed to add_datafile(). The name may
+        still be changed by add_datafile() if it is already in use.
+
+        progress, if given, is called as progress(stage, address,
+        fraction) as the load advances, where stage is one of
+        'boards', 'calibration', 'hash', 'decode', 'temperature',
+        'filter', 'segment', 'Tc', 'Tcerror' and 'done', address is the
+        board being worked on (or None) and fraction is the fraction of
+        the file's samples processed so far. Each sample is counted
+        once when the file is hashed, once when decoded, once when used
+        in the Tc computation and, if the Tc errors are estimated, once
+        more in their bootstrap.
+
+        cancel, if given, is an HKECancelToken. It is checked between
+        blocks of the file while it is hashed, between boards and
+        between chunks of chunksize samples in the Tc computation, and
+        HKEPlotLoadCancelledError is raised if it has been cancelled.
+        Since nothing is stored on the model, a cancelled load leaves
+        it untouched.
+
+        taddress and tchannel, if given, override the thermometer
+        board and channel specified in the boards file.
+
+        For files too large for memory, spill may be given as a folder
+        (or True, for the default temporary folder). The first decoded
+        register is then moved to a memory-mapped temporary file and
+        the others are decoded into preallocated ones, and the Tcs are
+        computed by streaming chunks of chunksize samples through
+        memory, see _stream_tcs.
+
+        window, if given, is a (start, stop) pair of sample indices, as
+        in a slice. Only the samples in the window are calibrated and
+        used for the Tcs, and each board's 'data' is a view of them;
+        the whole decoded register stays available as 'fulldata', so
+        the window can be changed with set_window() without reading
+        the file again. It is moved to a memory-mapped temporary file
+        (in spill, if given), so only the window is held in memory.
+        (None, None) is the same as no window, and a window holding no
+        samples raises HKEPlotError.
+
+        params, if given, are the parameters of the processing stages
+        to use, as {stage: {name: value}}, see set_params(). For
+        example {'Tcerror': {'method': 'bootstrap'}} estimates the
+        errors of the Tcs during the load.
+        """
+        if window is not None and tuple(window) == (None, None):
+            window = None
+        if progress is None:
+            progress = lambda stage, address, fraction: None
+        if cancel is None:
+            cancel = HKECancelToken()
+
         hkefname = os.path.abspath(hkefname)
         folder, name = os.path.split(hkefname)
         fn, ext = os.path.splitext(hkefname)
@@ -91,7 +233,9 @@ class HKEModel(object):
 
         calfname = os.path.abspath(calfname)
 
+        progress('boards', None, 0.)
         hkefile = BinaryFile(hkefname)
+        metadata = HKEMetadata(hkefile)
         if bcfgfile is None:
             bcfgfile = newcfgname
         try:
@@ -100,6 +244,28 @@ class HKEModel(object):
             raise HKEPlotLoadError(hkefname, calfname)
 
         boards = boardsdict['boards']
+        addresses = [addr for addr in boards.keys()
+                     if boards[addr]['type'] not in ['pmaster']]
+
+        # All registers hold the same number of samples per channel, so
+        # the fraction of samples processed only depends on the
+        # channel counts, which are known from the header before
+        # decoding.
+        weights = {}
+        for addr in addresses:
+            regname = construct_register_name(boards, addr)
+            boards[addr]['register_name'] = regname
+            weights[addr] = (metadata.nchannels(regname, decode=False) or
+                             len(boards[addr]['registers']) or 1)
+        hashweight = sum(weights.values())
+        errparams = dict(self.defaults['Tcerror'])
+        errparams.update((params or {}).get('Tcerror', {}))
+        passes = 3. if errparams['method'] == 'none' else 4.
+        total = passes*hashweight or 1.
+        done = 0.
+
+        progress('calibration', None, 0.)
+        cancel.check(hkefname)
 
         # Load thermometer interpolation curves
         cal = self._cal_load(calfname)
@@ -111,69 +277,955 @@ class HKEModel(object):
         TofR = interp1d(calRs, calTs, bounds_error=False,
                         fill_value=-1.)
 
-        # Load data from datafile
-        for addr in boards.keys():
-            t = boards[addr]['type']
-            if t not in ['pmaster']:
-                regname = construct_register_name(boards, addr)
-                boards[addr]['register_name'] = regname
-                data = hkefile.get_data(regname).T
-                boards[addr]['data'] = data
-
-        # Use first available data register as T, if none specified.
-        # if taddress is None:
-        #     print "toaddress is None!" #DELME
-        #     treg = boards.values()[0]
-        #     taddress = treg['address']
-        #     tchannel = 0
-        # else:
-        #     treg = boards[taddress]
-        taddress = boardsdict['temperature']['address']
-        tchannel = boardsdict['temperature']['channel']
-        if taddress is None:
-            treg = boards.values()[0]
-        else:
-            treg = boards[taddress]
-        if tchannel is None:
-            tchannel = 0
-        dataT = treg['data'][tchannel]
+        # Load data from datafile, the registers in file order.
+        # Registers already decoded from an identical file are reused.
+        def hashstep(fraction):
+            cancel.check(hkefname)
+            progress('hash', None, fraction*hashweight/total)
 
-        Ts = TofR(dataT)
+        filehash = self.file_hash(hkefname, callback=hashstep)
+        done = hashweight
+        shared = self._shared.get(filehash, {}).get('data', {})
+        regaddrs = dict((boards[addr]['register_name'], addr)
+                        for addr in addresses)
+        missing = [regname for regname in regaddrs.keys()
+                   if regname not in shared]
+        decoded = []
 
-        # Compute TCs
-        for addr in boards.keys():
-            t = boards[addr]['type']
-            if t not in ['pmaster']:
-                data = boards[addr]['data']
-                Tcs = array([self.find_mid_temp(rs, Ts) for rs in data])
-                boards[addr]['Tcs'] = Tcs
+        def regstart(regname):
+            cancel.check(hkefname)
+            addr = regaddrs[regname]
+            progress('decode', addr, (done + sum(decoded))/total)
+            decoded.append(weights[addr])
+
+        # Once the first register gives the number of samples, the
+        # others are decoded into preallocated memory-mapped files
+        regdata = extract_registers(hkefile, missing, callback=regstart,
+                                    spill=spill, metadata=metadata)
+        for regname, addr in regaddrs.items():
+            if regname in shared:
+                raw = shared[regname]
+            else:
+                raw = regdata[regname]
+                if ((window is not None) and
+                    not isinstance(self._base_array(raw), memmap)):
+                    raw = spill_array(raw, spill or True)
+                # Shared between entries, so must never change
+                raw.flags.writeable = False
+            metadata.set_shape(regname, raw.shape)
+            self._check_window(window, len(raw), hkefname)
+            boards[addr]['fulldata'] = raw.T
+            boards[addr]['data'] = raw.T[:, self._window_slice(window)]
+            done += weights[addr]
+
+        cancel.check(hkefname)
+        tdict = boardsdict['temperature']
+        if taddress is not None:
+            tdict['address'] = taddress
+        if tchannel is not None:
+            tdict['channel'] = tchannel
+        # Recorded, so that the thermometer is known when the entry is
+        # saved to the config file or an archive
+        tdict['address'], tdict['channel'] = self._thermometer(boardsdict)
+        tdict['TofR'] = TofR
+        tdict['RofT'] = RofT
+        boardsdict['hash'] = filehash
+        boardsdict['window'] = window
+        boardsdict['params'] = dict((stage, dict(stageparams))
+                                    for stage, stageparams
+                                    in (params or {}).items())
+
+        # Run the rest of the pipeline, computing the Tcs a chunk at a
+        # time. The outputs are only memoized once the entry is added.
+        decodedfraction = done/total
+        bases = {}
+        for addr in sorted(addresses):
+            bases[addr] = done
+            done += weights[addr]
+        errbases = {}
+        for addr in sorted(addresses):
+            errbases[addr] = done
+            done += weights[addr]
+
+        def stagestep(stage, addr, i):
+            cancel.check(hkefname)
+            if stage == 'Tc':
+                weight = weights[addr]/float(len(boards[addr]['data']) or 1)
+                progress('Tc', addr, (bases[addr] + i*weight)/total)
+            elif stage == 'Tcerror':
+                weight = weights[addr]/float(len(boards[addr]['data']) or 1)
+                progress('Tcerror', addr, (errbases[addr] + i*weight)/total)
+            elif stage == 'calibrate':
+                progress('temperature', None, decodedfraction)
+            elif stage in ('filter', 'segment'):
+                progress(stage, addr, decodedfraction)
+
+        self.run_pipeline(boardsdict, stagestep, memo={},
+                          chunksize=chunksize)
 
         boardsdict['filename'] = os.path.abspath(hkefname)
         boardsdict['file'] = hkefile
+        boardsdict['metadata'] = metadata
         boardsdict['calfile'] = calfname
         boardsdict['boardsfile'] = newcfgname
         if isinstance(description, StringTypes):
             boardsdict['description'] = description
 
-        boardsdict['temperature'] = {'address': taddress,
-                                     'channel': tchannel,
-                                     'Ts': Ts,
-                                     'TofR': TofR,
-                                     'RofT': RofT}
+        progress('done', None, 1.)
+
+        return name, boardsdict
 
-        # Save copy of the config file.
-        if not os.path.isfile(newcfgname):
+    def add_datafile(self, name, boardsdict):
+        """
+        Add a data dictionary, as returned by readfile(), to the model
+        under the specified name, or, if the model already has an item
+        of that name, under the name with ' (2)', ' (3)', etc.
+        appended. Returns the name used.
+        """
+        name = self.unique_name(name)
+
+        # Save copy of the config file. Entries read from archives keep
+        # the path on the exporting machine, so none is written for them.
+        newcfgname = boardsdict['boardsfile']
+        if ('archive' not in boardsdict) and not os.path.isfile(newcfgname):
             save_board_file(boardsdict, newcfgname)
 
+        # Share one read-only copy of the decoded register data between
+        # all entries loaded from identical files. Only the calibration
+        # dependent arrays (Ts, Tcs) belong to each entry.
+        shared = self._shared.setdefault(boardsdict['hash'],
+                                         {'data': {}, 'count': 0})
+        shared['count'] += 1
+        window = self._window_slice(boardsdict.get('window'))
+        for board in boardsdict['boards'].values():
+            if 'data' not in board:
+                continue
+            regname = board['register_name']
+            # Entries read from archives only hold their window, which
+            # must not stand in for the whole register
+            if ('fulldata' not in board) and boardsdict.get('window'):
+                continue
+            fulldata = board.get('fulldata', board['data'])
+            if regname in shared['data']:
+                fulldata = shared['data'][regname].T
+            else:
+                shared['data'][regname] = fulldata.T
+            if 'fulldata' in board:
+                board['fulldata'] = fulldata
+                board['data'] = fulldata[:, window]
+            else:
+                board['data'] = fulldata
+
+        # Take over the stage outputs computed by readfile()
+        for (stage, addr), key in boardsdict.get('keys', {}).items():
+            if (stage != 'decode') and (key not in self._memo):
+                self._memo[key] = self._fetch(boardsdict, stage, addr)
+
         self.datafiles[name] = boardsdict
         self.orderedkeys.append(name)
+        return name
 
-        return True
+    def unique_name(self, name):
+        """
+        Returns name, or if the model already has an item of that name,
+        the first of name + ' (2)', name + ' (3)', etc. that it does
+        not have.
+        """
+        newname = name
+        i = 2
+        while newname in self.datafiles:
+            newname = '{0} ({1})'.format(name, i)
+            i += 1
+        return newname
+
+    def file_hash(self, fname, blocksize=2**20, callback=None):
+        """
+        Returns the SHA-1 hash of the contents of the file fname. The
+        hash is cached until the size or modification time of the file
+        changes.
+
+        callback, if given, is called as callback(fraction) before
+        each block of blocksize bytes is read, with the fraction of
+        the file hashed so far; it may raise to abort.
+        """
+        fname = os.path.abspath(fname)
+        stat = os.stat(fname)
+        key = (fname, stat.st_size, stat.st_mtime)
+        if key not in self._hashes:
+            sha = hashlib.sha1()
+            size = float(stat.st_size or 1)
+            with open(fname, 'rb') as f:
+                if callback is not None:
+                    callback(0.)
+                block = f.read(blocksize)
+                while block:
+                    sha.update(block)
+                    if callback is not None:
+                        callback(f.tell()/size)
+                    block = f.read(blocksize)
+            self._hashes[key] = sha.hexdigest()
+        return self._hashes[key]
+
+    def memory_usage(self):
+        """
+        Returns a dictionary of the number of bytes used by the arrays
+        of all the entries in the model. 'total' counts the arrays
+        shared between entries once, while 'unshared' is the number of
+        bytes that would be used if every entry had its own copy.
+        'mapped' is the part of 'total' held in memory-mapped files
+        rather than in memory, see readfile().
+        """
+        seen = set()
+        total = 0
+        unshared = 0
+        mapped = 0
+        for df in self.datafiles.values():
+            arrays = [df['temperature']['Ts']]
+            for board in df['boards'].values():
+                # The data may be a window of the full register
+                arrays.extend([board[key] for key in ('fulldata', 'Tcs')
+                               if key in board])
+                if ('data' in board) and ('fulldata' not in board):
+                    arrays.append(board['data'])
+            for a in arrays:
+                base = self._base_array(a)
+                unshared += a.nbytes
+                if id(base) not in seen:
+                    seen.add(id(base))
+                    total += a.nbytes
+                    if isinstance(base, memmap):
+                        mapped += a.nbytes
+        return {'total': total, 'unshared': unshared, 'mapped': mapped}
+
+    def _base_array(self, a):
+        """
+        Returns the array that owns the memory of the array a.
+        """
+        while isinstance(a.base, ndarray):
+            a = a.base
+        return a
+
+    def export(self, fname, names=None):
+        """
+        Save the entries names (by default all) to the archive file
+        fname, from which they can be reloaded much faster than with
+        loadfile(). See the hkearchive module.
+        """
+        hkearchive.export_entries(self, fname, names)
+
+    def loadarchive(self, fname, names=None, boards=None):
+        """
+        Add the entries names (by default all) stored in the archive
+        file fname to the model. If boards is given, only the data of
+        the boards with those addresses is read.
+        """
+        for name, boardsdict in hkearchive.load_entries(fname, names,
+                                                        boards):
+            self.add_datafile(name, boardsdict)
+
+    def rederive(self, name):
+        """
+        Bring the processed data of model item name up to date with its
+        data, thermometer, calibration and stage parameters. Only the
+        stages whose inputs or parameters have changed are recomputed,
+        see HKEModel.run_pipeline.
+        """
+        self.run_pipeline(self[name])
+        self._prune_memo()
+
+    def set_params(self, name, stage, **params):
+        """
+        Set parameters of the processing stage (see HKEModel.stages) of
+        model item name, and recompute that stage and those after it.
+        Parameters not given keep their current values.
+        """
+        df = self[name]
+        stageparams = df.setdefault('params', {}).setdefault(stage, {})
+        stageparams.update(params)
+        self.rederive(name)
+
+    def run_pipeline(self, df, callback=None, memo=None, chunksize=2**22):
+        """
+        Compute the stages of the pipeline (see HKEModel.stages) for
+        the entry df, reusing memoized outputs where possible.
+
+        Every stage output is keyed by a hash of the stage name, its
+        parameters and the keys of its inputs, so an output is reused
+        whenever none of its upstream stages or parameters changed,
+        including from another entry loaded from the same file with
+        the same calibration. The keys are stored in df['keys'].
+
+        callback, if given, is called as callback(stage, address, i)
+        before a stage is computed for a board (address None for entry
+        stages) and before each chunk of chunked stages, where i is
+        the number of channels' worth of work done in the stage so
+        far.
+
+        New outputs are memoized in memo, if given, instead of in the
+        model, so that readfile() leaves the model untouched; they are
+        taken over by add_datafile().
+        """
+        if memo is None:
+            memo = self._memo
+        missing = object()
+        addresses = sorted([addr for addr, board in df['boards'].items()
+                            if 'data' in board])
+
+        keys = {}
+        for stage, scope, inputs in self.stages:
+            targets = addresses if scope == 'board' else [None]
+            for addr in targets:
+                params = self._stage_params(df, stage, addr)
+                inkeys = [self._input_key(keys, inp, addr, addresses)
+                          for inp in inputs]
+                key = hashlib.sha1(repr((stage, sorted(params.items()),
+                                         inkeys))).hexdigest()
+                keys[(stage, addr)] = key
+                if stage == 'decode':
+                    continue
+                # The model's memo may be pruned by another thread while
+                # readfile() runs, so it is only read with get()
+                output = memo.get(key, self._memo.get(key, missing))
+                if output is missing:
+                    if callback is None:
+                        step = None
+                    else:
+                        step = (lambda i, stage=stage, addr=addr:
+                                callback(stage, addr, i))
+                        step(0)
+                    method = getattr(self, '_stage_' + stage)
+                    output = method(df, addr, params, step, chunksize)
+                    memo[key] = output
+                self._store(df, stage, addr, output)
+        df['keys'] = keys
+
+    def _stage_params(self, df, stage, addr):
+        """
+        Returns the parameters of a stage of entry df, as they enter
+        the key of its output. These are the defaults updated with
+        df['params'], and for the source stages the description of
+        where their data came from.
+        """
+        params = dict(self.defaults.get(stage, {}))
+        params.update(df.get('params', {}).get(stage, {}))
+        if stage == 'decode':
+            board = df['boards'][addr]
+            params.update({'hash': df.get('hash'),
+                           'register': board.get('register_name'),
+                           'window': df.get('window')})
+        elif stage == 'calibrate':
+            address, channel = self._thermometer(df)
+            RofT = df['temperature']['RofT']
+            calhash = hashlib.sha1(asarray(RofT.x).tostring() +
+                                   asarray(RofT.y).tostring()).hexdigest()
+            params.update({'address': address, 'channel': channel,
+                           'calibration': calhash})
+        return params
+
+    def _thermometer(self, df):
+        """
+        Returns the board address and channel of the thermometer of
+        entry df, defaulting to channel 0 of the first board with data.
+        The entry itself is not changed.
+        """
+        boards = df['boards']
+        tdict = df['temperature']
+        address, channel = tdict['address'], tdict['channel']
+        if address is None:
+            address = [addr for addr in sorted(boards.keys())
+                       if 'data' in boards[addr]][0]
+        if channel is None:
+            channel = 0
+        return address, channel
+
+    def _input_key(self, keys, stage, addr, addresses):
+        """
+        Returns the key of the output of stage used as an input for
+        the board address (None for entry stages). An entry stage that
+        takes a board stage as input depends on all of its boards.
+        """
+        if (stage, addr) in keys:
+            return keys[(stage, addr)]
+        if (stage, None) in keys:
+            return keys[(stage, None)]
+        return tuple(keys[(stage, a)] for a in addresses)
+
+    def _store(self, df, stage, addr, output):
+        if addr is None:
+            target = df
+        else:
+            target = df['boards'][addr]
+        if stage == 'calibrate':
+            target = df['temperature']
+        names = self.outputs[stage]
+        if isinstance(names, tuple):
+            target.update(zip(names, output))
+        else:
+            target[names] = output
+
+    def _fetch(self, df, stage, addr):
+        if addr is None:
+            target = df
+        else:
+            target = df['boards'][addr]
+        if stage == 'calibrate':
+            target = df['temperature']
+        names = self.outputs[stage]
+        if isinstance(names, tuple):
+            return tuple(target[name] for name in names)
+        return target[names]
+
+    def _prune_memo(self):
+        """
+        Forget the memoized stage outputs that no entry uses.
+        """
+        used = set()
+        for df in self.datafiles.values():
+            used.update(df.get('keys', {}).values())
+        for key in self._memo.keys():
+            if key not in used:
+                del self._memo[key]
+
+    def set_thermometer(self, name, address, channel=0):
+        """
+        Use the specified board address and channel as the thermometer
+        of model item name.
+
+        The decoded board data and the calibration are reused, and only
+        the temperatures and the quantities derived from them are
+        recomputed.
+        """
+        df = self[name]
+        if 'data' not in df['boards'].get(address, {}):
+            raise HKEPlotError("Board {0} has no data loaded in {1}. Add "
+                               "it to the boards file to use it as the "
+                               "thermometer.".format(address, name))
+        tdict = df['temperature']
+        tdict['address'] = address
+        tdict['channel'] = channel
+        self.rederive(name)
+
+    def set_window(self, name, start=None, stop=None):
+        """
+        Restrict model item name to the samples from start to stop, as
+        in a slice; None for both selects the whole file. The window
+        is cut from the register data decoded when the file was read,
+        so widening it does not read the file again. Only the
+        temperatures and the quantities derived from them are
+        recomputed.
+        """
+        df = self[name]
+        boards = [board for board in df['boards'].values()
+                  if 'data' in board]
+        if not all([('fulldata' in board) for board in boards]):
+            raise HKEPlotError("{0} was not read from a data file, so "
+                               "its window cannot be "
+                               "changed.".format(name))
+        window = (start, stop)
+        if window == (None, None):
+            window = None
+        for board in boards:
+            self._check_window(window, board['fulldata'].shape[-1], name)
+        for board in boards:
+            board['data'] = board['fulldata'][:, self._window_slice(window)]
+        df['window'] = window
+        self.rederive(name)
+
+    def _check_window(self, window, nsamples, name):
+        """
+        Raise HKEPlotError if window selects none of nsamples samples.
+        """
+        if window is None:
+            return
+        if not len(xrange(*self._window_slice(window).indices(nsamples))):
+            raise HKEPlotError("The window {0} holds none of the {1} "
+                               "samples of {2}.".format(window, nsamples,
+                                                        name))
+
+    def _window_slice(self, window):
+        """
+        Returns the slice of samples selected by window, a (start,
+        stop) pair or None for all samples.
+        """
+        if window is None:
+            return slice(None)
+        return slice(*window)
+
+    def _stage_calibrate(self, df, addr, params, callback, chunksize):
+        """
+        Compute the temperatures from the thermometer channel and the
+        calibration curve.
+        """
+        tdict = df['temperature']
+        board = df['boards'].get(params['address'], {})
+        if 'data' not in board:
+            raise HKEPlotError("The thermometer board {0} holds no "
+                               "data.".format(params['address']))
+        dataT = board['data'][params['channel']]
+        return tdict['TofR'](dataT)
+
+    def _stage_filter(self, df, addr, params, callback, chunksize):
+        """
+        Returns the data of board addr cleaned for the Tc computation,
+        as a dictionary of the cleaned 'data' and a 'mask' of the
+        samples rejected, or None if none were. Method 'none' passes
+        the data through, and 'mad' rejects glitches, see
+        HKEModel.reject_glitches.
+        """
+        data = df['boards'][addr]['data']
+        method = params['method']
+        if method == 'none':
+            return {'data': data, 'mask': None}
+        if method == 'mad':
+            cleaned, mask = self.reject_glitches(data, params['window'],
+                                                 params['nsigma'],
+                                                 chunksize, callback)
+            return {'data': cleaned, 'mask': mask}
+        raise HKEPlotError("Unknown filter method "
+                           "'{0}'.".format(method))
+
+    def _stage_Trange(self, df, addr, params, callback, chunksize):
+        """
+        Returns the lowest and highest valid temperature, or None if
+        there are none.
+        """
+        Ts = df['temperature']['Ts']
+        Ts = Ts[isfinite(Ts) & (Ts > 0)]
+        if not len(Ts):
+            return None
+        return Ts.min(), Ts.max()
+
+    def _stage_segment(self, df, addr, params, callback, chunksize):
+        """
+        Returns the boolean mask of the samples used for the Tcs, or
+        None for all of them. With method 'range', these are the
+        samples with temperatures between the parameters Tmin and
+        Tmax. The mask is applied a chunk at a time by the stages that
+        use it, so the data are never copied as a whole.
+        """
+        method = params['method']
+        if method == 'all':
+            return None
+        if method == 'range':
+            Ts = df['temperature']['Ts']
+            segment = (Ts >= params['Tmin']) & (Ts <= params['Tmax'])
+            if not segment.any():
+                raise HKEPlotError("No samples have temperatures between "
+                                   "{0} and {1} K.".format(params['Tmin'],
+                                                           params['Tmax']))
+            return segment
+        raise HKEPlotError("Unknown segment method "
+                           "'{0}'.".format(method))
+
+    def _stage_Tc(self, df, addr, params, callback, chunksize):
+        """
+        Compute the Tcs of board addr from its filtered data and the
+        temperatures of the selected segment. Returns the Tcs and, for
+        method 'fit', the transition widths and fit residuals, which
+        are None for method 'midpoint'. See HKEModel.fit_transitions.
+        """
+        method = params['method']
+        data = df['boards'][addr]['filtered']['data']
+        Ts = df['temperature']['Ts']
+        segment = df['segment']
+        if method == 'midpoint':
+            Tcs = self._compute_tcs(data, Ts, chunksize, callback,
+                                    params['midfraction'], segment)
+            return Tcs, None, None
+        if method == 'fit':
+            # Samples outside the segment have no valid temperature, so
+            # they fall outside the bins
+            if segment is not None:
+                Ts = where(segment, Ts, nan)
+            return self.fit_transitions(data, Ts, params['nbins'],
+                                        chunksize=chunksize)
+        raise HKEPlotError("Unknown Tc method "
+                           "'{0}'.".format(method))
+
+    def _stage_Tcerror(self, df, addr, params, callback, chunksize):
+        """
+        Returns the uncertainties of the Tcs of board addr, or None for
+        method 'none'. Method 'bootstrap' estimates them from
+        nresamples bootstrap replicates of the Tcs, computed with the
+        method and parameters of the Tc stage, see
+        hkebootstrap.bootstrap_tcs.
+        """
+        method = params['method']
+        if method == 'none':
+            return None
+        if method != 'bootstrap':
+            raise HKEPlotError("Unknown Tc error method "
+                               "'{0}'.".format(method))
+        data = df['boards'][addr]['filtered']['data']
+        Ts = df['temperature']['Ts']
+        # The replicates are drawn from the samples of the segment
+        segment = df['segment']
+        samples = None if segment is None else nonzero(segment)[0]
+        tcparams = self._stage_params(df, 'Tc', addr)
+        if tcparams['method'] not in ('midpoint', 'fit'):
+            raise HKEPlotError("Unknown Tc method "
+                               "'{0}'.".format(tcparams['method']))
+
+        step = None
+        if callback is not None:
+            nresamples = float(params['nresamples'] or 1)
+            step = lambda n: callback(len(data)*n/nresamples)
+        return bootstrap_tcs(data, Ts, params['nresamples'],
+                             params['seed'], tcparams['method'],
+                             tcparams['midfraction'], tcparams['nbins'],
+                             samples=samples, callback=step)
+
+    def _stage_summary(self, df, addr, params, callback, chunksize):
+        """
+        Returns the summary of every channel of board addr, see
+        HKEModel.summary.
+        """
+        board = df['boards'][addr]
+        return self._summarize(board['filtered']['data'],
+                               df['temperature']['Ts'], board['Tcs'],
+                               params['normalfraction'], chunksize,
+                               callback)
+
+    def _stage_binned(self, df, addr, params, callback, chunksize):
+        """
+        Returns a new, empty cache for HKEModel.binned.
+        """
+        return {}
+
+    def _stage_resampled(self, df, addr, params, callback, chunksize):
+        """
+        Returns a new, empty cache for HKEModel.resampled.
+        """
+        return {}
 
     ########################################
     ########## Utility Functions ###########
     ########################################
 
+    def temperature_range(self, name):
+        """
+        Returns the lowest and highest valid temperature of model item
+        name. Raises HKEPlotError if it has none.
+        """
+        df = self[name]
+        if 'Trange' in df:
+            Trange = df['Trange']
+        else:
+            # Entries read from archives are not rederived on loading
+            Trange = self._stage_Trange(df, None, {}, None, None)
+        if Trange is None:
+            raise HKEPlotError("{0} has no valid "
+                               "temperatures.".format(name))
+        return Trange
+
+    def binned(self, name, address, grid):
+        """
+        Returns the data of every channel of board address of model
+        item name averaged onto a temperature grid, as a dictionary
+        with the bin 'edges' and 'centers', and the 'mean', 'std' and
+        'count' of the samples in each bin. mean and std have shape
+        (nchannels, nbins) and are NaN for empty bins; count has shape
+        (nbins,), as all channels share the temperatures.
+
+        grid is either (Tmin, Tmax, nbins), for nbins equal bins, or a
+        sequence of bin edges. The result is cached per grid until the
+        temperatures or data change.
+        """
+        df = self[name]
+        board = df['boards'][address]
+        if 'data' not in board:
+            raise HKEPlotError("Board {0} has no data loaded in "
+                               "{1}.".format(address, name))
+        if len(grid) == 3:
+            Tmin, Tmax, nbins = grid
+            edges = linspace(Tmin, Tmax, int(nbins) + 1)
+        else:
+            edges = asarray(grid, dtype=float64)
+        key = (address, tuple(edges))
+
+        cache = df.setdefault('binned', {})
+        if key not in cache:
+            mean, std, count = self._bin_data(board['data'],
+                                              df['temperature']['Ts'],
+                                              edges)
+            cache[key] = {'edges': edges,
+                          'centers': (edges[:-1] + edges[1:])/2.,
+                          'mean': mean, 'std': std, 'count': count}
+        return cache[key]
+
+    def summary(self, name, address):
+        """
+        Returns the summary of every channel of board address of model
+        item name, as a structured array with the fields of
+        HKEModel.summarydtype: the channel, its lowest, highest and
+        normal-state resistances, its noise floor, its Tc and the
+        number of samples.
+
+        The normal-state resistance is the median over the samples in
+        the warmest tenth of the temperature range, and the noise floor
+        is the robust standard deviation of the sample-to-sample
+        differences, divided by sqrt(2).
+
+        The summaries are computed when a file is loaded, so they can
+        be sorted and filtered without touching the data; entries read
+        from archives are summarized on first use.
+        """
+        df = self[name]
+        board = df['boards'][address]
+        if 'data' not in board:
+            raise HKEPlotError("Board {0} has no data loaded in "
+                               "{1}.".format(address, name))
+        if board.get('summary') is None:
+            params = self._stage_params(df, 'summary', address)
+            board['summary'] = self._summarize(board['data'],
+                                               df['temperature']['Ts'],
+                                               board['Tcs'],
+                                               params['normalfraction'])
+        return board['summary']
+
+    def select_channels(self, name, address, sortby='channel',
+                        descending=False, filters=()):
+        """
+        Returns the channels of board address of model item name that
+        pass every filter, sorted by the summary field sortby. Each
+        filter is a (field, op, value) triple, where op is one of '<',
+        '<=', '>', '>=', '==' and '!='.
+        """
+        summary = self.summary(name, address)
+        ops = {'<': less, '<=': less_equal, '>': greater,
+               '>=': greater_equal, '==': equal, '!=': not_equal}
+        keep = ones(len(summary), dtype=bool)
+        for field, op, value in filters:
+            if field not in summary.dtype.names:
+                raise HKEPlotError("Unknown summary field "
+                                   "'{0}'.".format(field))
+            keep &= ops[op](summary[field], value)
+        selected = summary[keep]
+        order = argsort(selected[sortby], kind='mergesort')
+        if descending:
+            order = order[::-1]
+        return selected['channel'][order]
+
+    def _summarize(self, data, Ts, Tcs, normalfraction=.1,
+                   chunksize=2**22, callback=None):
+        """
+        Compute the summaries of every channel (row) of data, a chunk
+        of approximately chunksize samples at a time, see
+        HKEModel.summary. If given, callback is called as callback(i)
+        before the chunk starting at channel i is processed.
+        """
+        nch = len(data)
+        nsamples = data.shape[-1]
+        summary = zeros(nch, dtype=self.summarydtype)
+        summary['channel'] = arange(nch)
+        summary['Tc'] = Tcs
+        summary['nsamples'] = nsamples
+
+        Ts = asarray(Ts)
+        valid = isfinite(Ts) & (Ts > 0)
+        normal = zeros(len(Ts), dtype=bool)
+        if valid.any():
+            Tmin, Tmax = Ts[valid].min(), Ts[valid].max()
+            normal = valid & (Ts >= Tmax - (Tmax - Tmin)*normalfraction)
+        normal = nonzero(normal)[0]
+
+        step = int(chunksize//(nsamples or 1)) or 1
+        for i in range(0, nch, step):
+            if callback is not None:
+                callback(i)
+            chunk = asarray(data[i:i+step])
+            # A view, so the fields are filled in place
+            rows = summary[i:i+step]
+            if not nsamples:
+                continue
+            rows['minR'] = chunk.min(axis=-1)
+            rows['maxR'] = chunk.max(axis=-1)
+            if len(normal):
+                rows['normalR'] = median(chunk[:, normal], axis=-1)
+            else:
+                rows['normalR'] = nan
+            if nsamples > 1:
+                steps = abs(diff(chunk, axis=-1))
+                rows['noise'] = 1.4826*median(steps, axis=-1)/sqrt(2.)
+        return summary
+
+    def transitions(self, name, address, grid, smooth=5, threshold=.1):
+        """
+        Find every transition of every channel of board address of
+        model item name as a peak of the smoothed dR/dT of the data
+        binned onto grid (see HKEModel.binned).
+
+        dR/dT is taken between neighbouring non-empty bins after a
+        running mean over smooth bins, oriented so that each channel's
+        resistance rises overall. Peaks higher than threshold times
+        the channel's highest are transitions.
+
+        Returns a dictionary of the derivative, 'dRdT' (nchannels,
+        npoints) at the temperatures 'Tm', and, per transition, sorted
+        by channel and temperature, its 'channel', location 'T',
+        'height' (the peak dR/dT) and 'width' (the full width of the
+        peak at half its height). The result is cached with the binned
+        data.
+        """
+        binned = self.binned(name, address, grid)
+        key = ('transitions', address, tuple(binned['edges']), smooth,
+               threshold)
+        cache = self[name]['binned']
+        if key in cache:
+            return cache[key]
+
+        filled = binned['count'] > 0
+        T = binned['centers'][filled]
+        R = binned['mean'][:, filled]
+
+        # Running mean along each channel, from cumulative sums
+        smooth = int(smooth) if smooth < len(T) else len(T)
+        if smooth > 1:
+            csum = cumsum(R, axis=-1)
+            R = (csum[:, smooth-1:] -
+                 concatenate((zeros((len(R), 1)), csum[:, :-smooth]),
+                             axis=-1))/smooth
+            csum = cumsum(T)
+            T = (csum[smooth-1:] - concatenate(([0.], csum[:-smooth])))/smooth
+
+        Tm = (T[:-1] + T[1:])/2.
+        dRdT = diff(R, axis=-1)/diff(T)
+        dRdT *= where(R[:, -1:] >= R[:, :1], 1., -1.)
+
+        # Local maxima above the threshold, all channels at once
+        npoints = dRdT.shape[-1]
+        peak = zeros(dRdT.shape, dtype=bool)
+        if npoints > 2:
+            inner = dRdT[:, 1:-1]
+            peak[:, 1:-1] = (inner > dRdT[:, :-2]) & (inner >= dRdT[:, 2:])
+        highest = dRdT.max(axis=-1) if npoints else zeros(len(dRdT))
+        peak &= dRdT > threshold*highest[:, newaxis]
+        peak &= dRdT > 0
+        channel, index = nonzero(peak)
+        height = dRdT[channel, index]
+
+        # Half-height crossings either side of every peak at once
+        positions = arange(npoints)
+        below = dRdT[channel] < height[:, newaxis]/2.
+        left = where(below & (positions < index[:, newaxis]), positions,
+                     -1).max(axis=-1) if len(index) else index
+        right = where(below & (positions > index[:, newaxis]), positions,
+                      npoints).min(axis=-1) if len(index) else index
+        left = left.clip(0, npoints - 1)
+        right = right.clip(0, npoints - 1)
+
+        cache[key] = {'Tm': Tm, 'dRdT': dRdT, 'channel': channel,
+                      'T': Tm[index], 'height': height,
+                      'width': Tm[right] - Tm[left]}
+        return cache[key]
+
+    def resampled(self, name, address, grid):
+        """
+        Returns the data of every channel of board address of model
+        item name linearly interpolated onto a temperature axis, as a
+        dictionary with the temperatures 'Ts' and the resampled
+        'data', of shape (nchannels, npoints). Points outside the
+        measured temperature range are NaN.
+
+        grid is either (Tmin, Tmax, npoints), for equally spaced
+        temperatures, or a sequence of temperatures. The interpolation
+        weights are computed once per entry and grid, and shared by
+        all of its boards; the results are cached until the
+        temperatures or data change.
+        """
+        df = self[name]
+        board = df['boards'][address]
+        if 'data' not in board:
+            raise HKEPlotError("Board {0} has no data loaded in "
+                               "{1}.".format(address, name))
+        if len(grid) == 3:
+            Tmin, Tmax, npoints = grid
+            Tgrid = linspace(Tmin, Tmax, int(npoints))
+        else:
+            Tgrid = asarray(grid, dtype=float64)
+        gridkey = tuple(Tgrid)
+
+        # The weights are stored under the address 'weights'
+        cache = df.setdefault('resampled', {})
+        if ('weights', gridkey) not in cache:
+            cache[('weights', gridkey)] = self._interp_weights(
+                df['temperature']['Ts'], Tgrid)
+        if (address, gridkey) not in cache:
+            lo, hi, w, outside = cache[('weights', gridkey)]
+            data = board['data']
+            resampled = data[:, lo]*(1. - w) + data[:, hi]*w
+            resampled[:, outside] = nan
+            cache[(address, gridkey)] = {'Ts': Tgrid, 'data': resampled}
+        return cache[(address, gridkey)]
+
+    def _interp_weights(self, Ts, Tgrid):
+        """
+        Returns the sample indices lo and hi and weights w such that
+        data[..., lo]*(1 - w) + data[..., hi]*w linearly interpolates
+        data, sampled at the temperatures Ts, onto Tgrid, as numpy's
+        interp would after sorting by temperature. Also returns a mask
+        of the points of Tgrid outside the measured range.
+
+        Samples with invalid temperatures (NaN, or the -1 that the
+        calibration gives out of its range) are ignored.
+        """
+        Ts = asarray(Ts)
+        valid = nonzero(isfinite(Ts) & (Ts > 0))[0]
+        if len(valid) < 2:
+            raise HKEPlotError("Too few valid temperatures to "
+                               "interpolate.")
+        order = valid[argsort(Ts[valid], kind='mergesort')]
+        Tsorted = Ts[order]
+
+        n = len(order)
+        hi = searchsorted(Tsorted, Tgrid, side='right').clip(1, n - 1)
+        lo = hi - 1
+        dT = Tsorted[hi] - Tsorted[lo]
+        dT[dT == 0] = 1.
+        w = ((Tgrid - Tsorted[lo])/dT).clip(0., 1.)
+        outside = (Tgrid < Tsorted[0]) | (Tgrid > Tsorted[-1])
+        return order[lo], order[hi], w, outside
+
+    def _bin_data(self, data, Ts, edges, chunksize=2**22):
+        """
+        Average every channel (row) of data into the temperature bins
+        with the given edges, in one bincount per chunk of
+        approximately chunksize samples. Returns the mean, standard
+        deviation and count of the samples in each bin.
+        """
+        nbins = len(edges) - 1
+        bins = digitize(Ts, edges) - 1
+        # digitize puts Tmax itself past the last bin
+        bins[Ts == edges[-1]] = nbins - 1
+        valid = nonzero((bins >= 0) & (bins < nbins))[0]
+        bins = bins[valid]
+
+        count = bincount(bins, minlength=nbins)[:nbins]
+        filled = count > 0
+
+        nch = len(data)
+        mean = empty((nch, nbins))
+        mean.fill(nan)
+        std = mean.copy()
+        step = int(chunksize//(len(valid) or 1)) or 1
+        for i in range(0, nch, step):
+            chunk = data[i:i+step][:, valid]
+            n = len(chunk)
+            # One bin index per (channel, sample) pair, so all the
+            # channels of the chunk are binned by a single bincount
+            index = (arange(n)[:, newaxis]*nbins + bins).ravel()
+            sums = bincount(index, chunk.ravel(), minlength=n*nbins)
+            sums = sums.reshape(n, nbins)
+            mean[i:i+n, filled] = sums[:, filled]/count[filled]
+
+            deviations = chunk - mean[i:i+n][:, bins]
+            squares = bincount(index, (deviations**2).ravel(),
+                               minlength=n*nbins)
+            squares = squares.reshape(n, nbins)
+            std[i:i+n, filled] = sqrt(squares[:, filled]/count[filled])
+
+        return mean, std, count
+
     def _cal_load(self, calfname):
         """
         Load a cal curve. This method is more robust against format
@@ -194,6 +1246,263 @@ class HKEModel(object):
             cal = loadtxt(tmp)
             return cal
 
+    def _compute_tcs(self, data, Ts, chunksize=2**22, callback=None,
+                     midfraction=.5, mask=None):
+        """
+        Compute the Tcs of every channel of data, a chunk of
+        approximately chunksize samples at a time. If given, callback
+        is called as callback(i) before the chunk starting at channel i
+        is processed.
+
+        Data held in a memory-mapped file, or restricted to the samples
+        selected by the boolean mask, are streamed by _stream_tcs
+        instead.
+        """
+        if (mask is not None) or isinstance(self._base_array(data),
+                                            memmap):
+            return self._stream_tcs(data, Ts, chunksize, callback,
+                                    midfraction, mask)
+        nch = len(data)
+        step = int(chunksize//(data.shape[-1] or 1)) or 1
+        Tcs = empty(nch)
+        for i in range(0, nch, step):
+            if callback is not None:
+                callback(i)
+            Tcs[i:i+step] = self.find_mid_temps(data[i:i+step], Ts,
+                                                midfraction)
+        return Tcs
+
+    def _stream_tcs(self, data, Ts, chunksize=2**22, callback=None,
+                    midfraction=.5, mask=None):
+        """
+        Compute the Tcs of every channel (row) of data in two passes
+        over chunks of approximately chunksize samples, so that only
+        one chunk is in memory at a time: the first finds the minimum
+        and maximum of every channel, the second the sample nearest to
+        each midpoint. Gives exactly the same result as
+        find_mid_temps. If mask is given, only the samples it selects
+        are used, as with find_mid_temps(data[:, mask], Ts[mask]).
+
+        If given, callback is called as callback(i) before each chunk,
+        where i is the number of channels' worth of work done, as in
+        _compute_tcs.
+        """
+        nch, nsamples = data.shape
+        step = int(chunksize//(nch or 1)) or 1
+        starts = range(0, nsamples, step)
+        nchunks = 2.*len(starts) or 1.
+
+        Rmin = empty(nch)
+        Rmin.fill(inf)
+        Rmax = empty(nch)
+        Rmax.fill(-inf)
+        def columns(j):
+            # The samples of the chunk starting at j, and their indices
+            chunk = asarray(data[:, j:j+step])
+            index = arange(j, j + chunk.shape[-1])
+            if mask is not None:
+                selected = mask[j:j+step]
+                chunk, index = chunk[:, selected], index[selected]
+            return chunk, index
+
+        for k, j in enumerate(starts):
+            if callback is not None:
+                callback(nch*k/nchunks)
+            chunk, index = columns(j)
+            if not len(index):
+                continue
+            Rmin = minimum(Rmin, chunk.min(axis=-1))
+            Rmax = maximum(Rmax, chunk.max(axis=-1))
+        Rmid = Rmin + (Rmax - Rmin)*midfraction
+
+        # Only a strictly closer sample replaces the best so far, so
+        # ties go to the first sample, as with argmin
+        best = empty(nch)
+        best.fill(inf)
+        imid = zeros(nch, dtype=int)
+        channels = arange(nch)
+        for k, j in enumerate(starts):
+            if callback is not None:
+                callback(nch*(len(starts) + k)/nchunks)
+            chunk, index = columns(j)
+            if not len(index):
+                continue
+            distance = abs(chunk - Rmid[:, newaxis])
+            i = distance.argmin(axis=-1)
+            d = distance[channels, i]
+            closer = d < best
+            best[closer] = d[closer]
+            imid[closer] = index[i[closer]]
+
+        return asarray(Ts)[imid]
+
+    def reject_glitches(self, data, window=9, nsigma=5., chunksize=2**22,
+                        callback=None):
+        """
+        Find the glitches in every channel (row) of data, i.e. the
+        samples further than nsigma robust standard deviations from
+        the median of their window//2 neighbours on either side, and
+        replace them by that median. Returns the cleaned data and the
+        boolean mask of the glitches.
+
+        The sample itself is left out of the median it is compared
+        to, so its deviation is independent of the median and the
+        deviations are spread like the noise; included, it would pull
+        the median towards itself and the noise would be
+        underestimated. The standard deviation is estimated from the
+        median absolute deviation, per channel and per chunk
+        of approximately chunksize samples, which are processed one at
+        a time. Data held in a memory-mapped file are cleaned into
+        another. If given, callback is called as callback(i) before
+        each chunk, as in _compute_tcs.
+        """
+        nch, nsamples = data.shape
+        if isinstance(self._base_array(data), memmap):
+            cleaned = spill_array(data)
+        else:
+            cleaned = array(data)
+        mask = zeros((nch, nsamples), dtype=bool)
+
+        # The running median sorts window samples for each sample
+        half = int(window)//2
+        if half < 1:
+            raise HKEPlotError("The glitch window must span at least 3 "
+                               "samples.")
+        step = int(chunksize//((nch or 1)*(2*half + 1))) or 1
+        for j in range(0, nsamples, step):
+            if callback is not None:
+                callback(nch*float(j)/nsamples)
+            stop = j + step if j + step < nsamples else nsamples
+            lo = j - half if j > half else 0
+            hi = stop + half if stop + half < nsamples else nsamples
+            running = self.running_median(asarray(data[:, lo:hi]), window,
+                                          center=False)
+            running = running[:, j-lo:stop-lo]
+            chunk = asarray(data[:, j:stop])
+
+            residuals = abs(chunk - running)
+            scale = 1.4826*median(residuals, axis=-1)
+            # Quantized, quiet channels can have no spread in the median
+            scale = where(scale > 0, scale,
+                          1.2533*residuals.mean(axis=-1))
+            glitches = residuals > nsigma*scale[:, newaxis]
+            if glitches.any():
+                mask[:, j:stop] = glitches
+                cleaned[:, j:stop] = where(glitches, running, chunk)
+
+        return cleaned, mask
+
+    def running_median(self, data, window=9, center=True):
+        """
+        Returns the median of every sample of every channel (row) of
+        data and its neighbours within window//2 samples, repeating
+        the first and last samples beyond the edges. If center is
+        False, the sample itself is left out, so the median is that of
+        its neighbours only. The windows are strided views of the
+        data, so they are not copied before the median is taken.
+        """
+        half = int(window)//2
+        data = atleast_2d(data)
+        padded = concatenate((repeat(data[:, :1], half, axis=1), data,
+                              repeat(data[:, -1:], half, axis=1)), axis=1)
+        s0, s1 = padded.strides
+        windows = as_strided(padded, shape=(len(data), data.shape[1],
+                                            2*half + 1),
+                             strides=(s0, s1, s1))
+        if not center:
+            windows = windows[..., r_[0:half, half+1:2*half+1]]
+        return median(windows, axis=-1)
+
+    def fit_transitions(self, data, Ts, nbins=400, maxiter=50, tol=1.e-8,
+                        chunksize=2**22):
+        """
+        Fit the transition model
+
+            R(T) = R0 + (Rn - R0)*(1 + tanh((T - Tc)/width))/2
+
+        to every channel (row) of data at once. Returns the Tcs, the
+        widths and the RMS residuals of the fits.
+
+        The data are first averaged onto nbins temperature bins
+        spanning the valid temperatures (see HKEModel._bin_data), and
+        all the channels are then fitted together by a
+        Levenberg-Marquardt iteration, whose normal equations are
+        solved as one stack of 4x4 systems. Each channel keeps its own
+        damping and stops improving on its own; the iteration ends
+        when no channel's cost changes by more than tol relative, or
+        after maxiter steps.
+        """
+        Ts = asarray(Ts)
+        valid = Ts[isfinite(Ts) & (Ts > 0)]
+        if not len(valid):
+            raise HKEPlotError("No valid temperatures to fit.")
+        edges = linspace(valid.min(), valid.max(), int(nbins) + 1)
+        means, std, count = self._bin_data(data, Ts, edges, chunksize)
+        T = (edges[:-1] + edges[1:])/2.
+        weight = (count > 0).astype(float64)
+        R = where(isfinite(means), means, 0.)
+        nfilled = weight.sum() or 1.
+
+        # Initial guesses: the extremes and midpoint of the binned data
+        nch = len(R)
+        R0 = nanmin(means, axis=-1)
+        Rn = nanmax(means, axis=-1)
+        Rmid = (R0 + Rn)/2.
+        distance = where(weight > 0, abs(R - Rmid[:, newaxis]), inf)
+        p = column_stack((R0, Rn - R0, T[distance.argmin(axis=-1)],
+                          ones(nch)*10.*(edges[1] - edges[0])))
+        p[~isfinite(p)] = 0.
+
+        def model(p):
+            u = (T - p[:, 2:3])/p[:, 3:4]
+            s = tanh(u)
+            return p[:, 0:1] + p[:, 1:2]*(1. + s)/2., u, s
+
+        def cost(p):
+            f, u, s = model(p)
+            return (weight*(R - f)**2).sum(axis=-1)
+
+        damping = ones(nch)*1.e-3
+        current = cost(p)
+        for iteration in range(int(maxiter)):
+            f, u, s = model(p)
+            sech2 = 1. - s**2
+            J = empty((nch, len(T), 4))
+            J[..., 0] = 1.
+            J[..., 1] = (1. + s)/2.
+            J[..., 2] = -p[:, 1:2]*sech2/(2.*p[:, 3:4])
+            J[..., 3] = J[..., 2]*u
+            JW = J*weight[:, newaxis]
+            JTJ = einsum('nki,nkj->nij', JW, J)
+            g = einsum('nki,nk->ni', JW, R - f)
+
+            # Marquardt's scaling of the damping by the diagonal. The
+            # floor keeps flat channels, whose Tc and width do not
+            # affect the model, from making the stack singular.
+            diagonal = JTJ[:, arange(4), arange(4)]
+            floor = 1.e-12*diagonal.max(axis=-1)[:, newaxis] + 1.e-300
+            A = JTJ.copy()
+            A[:, arange(4), arange(4)] += (damping[:, newaxis]*diagonal +
+                                           floor)
+            try:
+                step = linalg.solve(A, g[..., newaxis])[..., 0]
+            except linalg.LinAlgError:
+                break
+            trial = p + step
+            trial[:, 3] = where(trial[:, 3] == 0, p[:, 3], trial[:, 3])
+            trialcost = cost(trial)
+
+            better = trialcost < current
+            change = where(better, (current - trialcost)/
+                           where(current > 0, current, 1.), 0.)
+            p[better] = trial[better]
+            current = where(better, trialcost, current)
+            damping = where(better, damping/10., damping*10.)
+            if (change < tol).all() and better.any():
+                break
+
+        return p[:, 2], abs(p[:, 3]), sqrt(current/nfilled)
+
     def find_nearest(self, array, value):
         idx = (abs(array-value)).argmin()
         return array[idx]
@@ -213,6 +1522,22 @@ class HKEModel(object):
 
         return Tmid
 
+    def find_mid_temps(self, data, Ts, midfraction=.5):
+        """
+        Find the temperatures of the half-max resistance of every
+        channel (row) of data at once. Gives the same result as
+        calling find_mid_temp on each row.
+        """
+        data = asarray(data)
+        Rmin = data.min(axis=-1)
+        Rmax = data.max(axis=-1)
+        Rmid = Rmin + (Rmax - Rmin)*midfraction
+
+        imid = (abs(data - Rmid[..., newaxis])).argmin(axis=-1)
+        Tmids = asarray(Ts)[imid]
+
+        return Tmids
+
     def rename(self, name, newname):
         """
         Renames a model item. The filename from which the model item
@@ -223,23 +1548,24 @@ class HKEModel(object):
             name = self.keys()[name]
         else:
             num = self.orderedkeys.index(name)
+        if (newname != name) and (newname in self.datafiles):
+            raise HKEPlotError("The model already has an item named "
+                               "{0}.".format(newname))
         self.datafiles[newname] = self.datafiles.pop(name)
         self.orderedkeys[num] = newname
 
-    def change_sources(self, name, treg, tch, s1reg, s2reg=None):
-        model = self[name]
-        f = model['file']
-        hkefname = f.filename
-        calfname = model['calfile']
-        desc = model['description']
-        dewar = model['dewar']
-
-        self.__delitem__(name)
+    def change_sources(self, name, treg, tch, s1reg=None, s2reg=None):
+        """
+        Change the thermometer of model item name to channel tch of
+        register treg, specified by name or index.
 
-        self.loadfile(hkefname, calfname, description=desc,
-                      dewar=dewar, tregister=treg, tchannel=tch,
-                      r1register=s1reg, r2register=s2reg)
-        self.rename(-1, name)
+        s1reg and s2reg are accepted for compatibility with the old
+        two-sided file format and are ignored; the data registers are
+        set by the boards file.
+        """
+        metadata = self[name]['metadata']
+        address = metadata.register_info(treg)['address']
+        self.set_thermometer(name, address, tch)
 
     def add_descriptions(self, name, descriptions, side=1):
         """
@@ -272,7 +1598,12 @@ class HKEModel(object):
 
     def __delitem__(self, key):
         self.orderedkeys.remove(key)
-        return self.datafiles.__delitem__(key)
+        filehash = self.datafiles[key]['hash']
+        self._shared[filehash]['count'] -= 1
+        if not self._shared[filehash]['count']:
+            del self._shared[filehash]
+        self.datafiles.__delitem__(key)
+        self._prune_memo()
 
     def __setitem__(self, *args):
         print "The HKEModel class does not support item assignment."
@@ -291,6 +1622,39 @@ class HKEModel(object):
         return tp
 
 
+class HKECancelToken(object):
+    """
+    A token used to cancel a running HKEModel load, e.g. from another
+    thread or a notebook callback.
+
+    >>> token = HKECancelToken()
+    >>> # in another thread...
+    >>> hkem.loadfile('hke_20130201_001.dat', 'U02728.txt', cancel=token)
+    >>> # ...and in this one
+    >>> token.cancel()
+    """
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    def reset(self):
+        self._event.clear()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def check(self, fname=None):
+        """
+        Raise HKEPlotLoadCancelledError if the token has been
+        cancelled.
+        """
+        if self.cancelled:
+            raise HKEPlotLoadCancelledError(fname)
+
+
 class HKEPlotError(Exception):
     """
     Generic error for hkeplot.
@@ -309,3 +1673,14 @@ class HKEPlotLoadError(HKEPlotError):
 
     def __str__(self):
         return self.msg
+
+
+class HKEPlotLoadCancelledError(HKEPlotError):
+    """
+    An error indicating that the loading of a file was cancelled.
+    """
+    def __init__(self, fname):
+        self.msg = "Loading of data file {0} cancelled.".format(fname)
+
+    def __str__(self):
+        return self.msg
@@ -4,9 +4,15 @@ of the data contained in an HKEModel model object.
 """
 
 # import matplotlib.pyplot as plt
+import os
+import time
+from cStringIO import StringIO
+from numpy import *
 from matplotlib.figure import Figure
 from matplotlib.axes import Subplot, Axes
 import matplotlib as mpl
+from hkefigures import render_state, vectorformats, draw_heatmap, \
+                       label_rows, tcmarkers
 
 
 class HKEPlotter(object):
@@ -30,6 +36,23 @@ class HKEPlotter(object):
         self.cc = mpl.rcParams['axes.color_cycle']
         self.usedcc = []
 
+        # Axis scales and legend location, recorded for get_state()
+        self.scales = {'x': ('linear', {}), 'y': ('linear', {})}
+        self.legendloc = None
+
+        # Zoom-aware decimation of R vs T lines; see redecimate()
+        self.decimate = True
+        self.pointsperpixel = 4
+        self.redecimatedelay = 100
+        self._redecimatetimer = None
+        self._redecimatecanvas = None
+        # Set while the plotter changes the limits itself and redecimates
+        # afterwards, so _onlimits need not schedule another redecimation
+        self._holdlimits = False
+
+        # The channels drawn as an image; see HeatmapPlot()
+        self.heatmap = None
+
     def makefigure(self, figsize=(4., 4.), dpi=100, **kwargs):
         self.figure = Figure(figsize=figsize, dpi=dpi, **kwargs)
         return self.figure
@@ -40,6 +63,7 @@ class HKEPlotter(object):
             return
 
         self.axes = self.figure.add_subplot(*args, **kwargs)
+        self._connect_limits()
         return self.axes
 
     def getnextcolor(self):
@@ -58,13 +82,15 @@ class HKEPlotter(object):
         return self.cc[i]
 
     def plot(self, *args, **kwargs):
+        # Lines are drawn on the R vs T axes, which the heatmap hides
+        self.clear_heatmap()
         color = self.getnextcolor()
         newline, = self.axes.plot(*args, color=color, **kwargs)
 
         linewidth = newline.get_linewidth()
 
         newlinedict = {'line': newline, 'color': color, 'vlines': [],
-                       'hlines': [], 'linewidth': linewidth,
+                       'hlines': [], 'tlines': [], 'linewidth': linewidth,
                        'highlighted': False, 'highlight factor': 1.0}
         self.lines.append(newlinedict)
 
@@ -73,10 +99,12 @@ class HKEPlotter(object):
     def resetplot(self):
         self.clearplot()
         self.axes.clear()
+        self._connect_limits()
 
     def clearplot(self):
         self._killlines()
         self.lines = []
+        self.clear_heatmap()
 
     def _killlines(self):
         for ld in self.lines:
@@ -128,13 +156,40 @@ class HKEPlotter(object):
             description = description + ' - ' + chdesc
 
         label = 'Ch {i}{d}'.format(i=chindex, d=description)
-        line = self.plot(Ts, Rs, label=label)
+        Tcerrors = board.get('Tcerrors')
+        if Tcerrors is not None:
+            label += ' (Tc = {0:.4g} $\pm$ {1:.2g} K)'.format(
+                board['Tcs'][chindex], Tcerrors[chindex])
+        Tc = board['Tcs'][chindex]
+
+        # With decimation the line is drawn from its visible samples
+        # only, so the axes limits come from the cached statistics
+        # rather than from scanning all of the data.
+        if self.decimate:
+            line = self.plot([], [], label=label)
+        else:
+            line = self.plot(Ts, Rs, label=label)
 
         linedict = self._get_linedict(line)
         linedict['label'] = label
-
-        Tc = board['Tcs'][chindex]
+        linedict['Ts'] = Ts
+        linedict['Rs'] = Rs
+        linedict['channel'] = chindex
         linedict['Tc'] = Tc
+        if Tcerrors is not None:
+            linedict['Tcerror'] = Tcerrors[chindex]
+        summary = board.get('summary')
+        Trange = datafile.get('Trange')
+        if (summary is not None) and (Trange is not None):
+            row = summary[chindex]
+            linedict['stats'] = {'Tmin': Trange[0], 'Tmax': Trange[1],
+                                 'Rmin': row['minR'], 'Rmax': row['maxR'],
+                                 'noise': row['noise'], 'Tc': Tc}
+        # Keep the view if the user has zoomed or set it
+        self.auto_limits(self.axes.get_autoscalex_on(),
+                         self.axes.get_autoscaley_on())
+        if self.decimate:
+            self.redecimate()
 
         if Tcline:
             self.addTcline(line, Tc)
@@ -169,22 +224,410 @@ class HKEPlotter(object):
 
         # return linedict
 
+    def BinnedRvsTPlot(self, name, boardindex, chindex, grid,
+                       description='', Tcline=True):
+        """
+        Makes an R vs T plot of a channel of model item name averaged
+        onto a temperature grid. See HKEModel.binned for the format of
+        grid. Empty bins are left out.
+        """
+        self._checkfigure()
+        datafile = self.model[name]
+        binned = self.model.binned(name, boardindex, grid)
+        filled = binned['count'] > 0
+        Ts = binned['centers'][filled]
+        Rs = binned['mean'][chindex][filled]
+
+        board = datafile['boards'][boardindex]
+        chdesc = board['registers'][chindex]['name']
+        if description:
+            description = ' - ' + description
+        if chdesc:
+            description = description + ' - ' + chdesc
+
+        label = 'Ch {i} (binned){d}'.format(i=chindex, d=description)
+        line = self.plot(Ts, Rs, label=label)
+
+        linedict = self._get_linedict(line)
+        linedict['label'] = label
+        linedict['Ts'] = Ts
+        linedict['Rs'] = Rs
+        linedict['channel'] = chindex
+        linedict['grid'] = grid
+        if self.decimate:
+            self.redecimate_line(linedict)
+
+        Tc = board['Tcs'][chindex]
+        linedict['Tc'] = Tc
+
+        if Tcline:
+            self.addTcline(line, Tc)
+
+        return linedict
+
+    def HeatmapPlot(self, name, grid, channels=None, normalize='range',
+                    cmap=None, Tcs=True):
+        """
+        Draws channels of model item name as a single image, one row
+        per channel of its resistance averaged onto the temperature
+        grid (see HKEModel.binned for its format), with the Tc of each
+        channel marked on its row if Tcs is True. channels is a list
+        of (address, channel) pairs, by default every channel of every
+        board with data. The rows are labelled 'address:channel' on
+        the y axis. It replaces any previous heatmap.
+
+        The heatmap is drawn on axes of its own, which take the place
+        of the R vs T axes until clear_heatmap() is called or a line is
+        plotted, so the redecimation of the lines does not run on it.
+
+        Every row is normalized according to normalize: 'range' scales
+        it from 0 to 1, 'normal' divides it by the normal-state
+        resistance of the channel (see HKEModel.summary) and None
+        leaves it in Ohms. Empty bins are left blank.
+
+        The image is made from the binned data, which the model
+        caches, so drawing it takes a time proportional to the number
+        of channels and bins, whatever the number of samples. Returns
+        self.heatmap, a dictionary of the 'artist', the 'scatter' of
+        Tcs, the 'image' data, the bin 'edges', the 'channels' and
+        their 'Tcs', and the 'axes' it is drawn on.
+        """
+        self._checkfigure()
+        df = self.model[name]
+        if channels is None:
+            channels = [(addr, ch)
+                        for addr, board in sorted(df['boards'].items())
+                        if 'data' in board
+                        for ch in range(len(board['data']))]
+        if not channels:
+            raise HKEPlotterNoChannelsError(name)
+
+        image = None
+        for row, (addr, ch) in enumerate(channels):
+            binned = self.model.binned(name, addr, grid)
+            if image is None:
+                edges = binned['edges']
+                image = empty((len(channels), len(edges) - 1))
+            image[row] = binned['mean'][ch]
+
+        with errstate(invalid='ignore', divide='ignore'):
+            if normalize == 'range':
+                low = nanmin(image, axis=1)[:, newaxis]
+                high = nanmax(image, axis=1)[:, newaxis]
+                image = (image - low)/where(high > low, high - low, 1.)
+            elif normalize == 'normal':
+                normalR = array([self.model.summary(name, addr)
+                                 ['normalR'][ch] for addr, ch in channels])
+                image = image/normalR[:, newaxis]
+
+        tcs = empty(len(channels))
+        for row, (addr, ch) in enumerate(channels):
+            boardTcs = df['boards'][addr].get('Tcs')
+            tcs[row] = boardTcs[ch] if boardTcs is not None else nan
+
+        self.clear_heatmap()
+        axes = self.figure.add_axes(self.axes.get_position(),
+                                    label='heatmap')
+        self.axes.set_visible(False)
+        artist = draw_heatmap(axes, image, edges, cmap)
+        scatter = None
+        if Tcs:
+            rows = arange(len(channels))
+            marked = isfinite(tcs) & (tcs > 0)
+            if marked.any():
+                scatter = axes.scatter(tcs[marked], rows[marked],
+                                       **tcmarkers)
+        axes.set_xlim(edges[0], edges[-1])
+        axes.set_ylim(-.5, len(channels) - .5)
+        rowlabels = ['{0}:{1}'.format(addr, ch) for addr, ch in channels]
+        label_rows(axes, rowlabels)
+        axes.set_title(self.axes.get_title())
+
+        self.heatmap = {'axes': axes, 'artist': artist, 'scatter': scatter,
+                        'image': image, 'edges': edges,
+                        'channels': channels, 'rowlabels': rowlabels,
+                        'Tcs': tcs, 'name': name, 'normalize': normalize}
+        return self.heatmap
+
+    def clear_heatmap(self):
+        """
+        Remove the heatmap drawn by HeatmapPlot(), if any, and show the
+        R vs T axes again.
+        """
+        if self.heatmap is None:
+            return
+        self.figure.delaxes(self.heatmap['axes'])
+        self.axes.set_visible(True)
+        self.heatmap = None
+
+    def _labelaxes(self):
+        """
+        Returns the axes shown, i.e. those of the heatmap if there is
+        one, else the R vs T axes.
+        """
+        if self.heatmap is not None:
+            return self.heatmap['axes']
+        return self.axes
+
+    def ComparisonPlot(self, comparison, channel, reference, grid,
+                       mode='difference', label=''):
+        """
+        Plots the difference or ratio (mode) of channel relative to
+        reference, resampled onto grid by the HKEComparison
+        comparison. Channels are (name, address, channel) tuples.
+        """
+        self._checkfigure()
+        if mode == 'ratio':
+            Ts, Rs = comparison.ratio(channel, reference, grid)
+        else:
+            Ts, Rs = comparison.difference(channel, reference, grid)
+
+        if not label:
+            op = '/' if mode == 'ratio' else '-'
+            label = 'Ch {0} {1} Ch {2} ({3})'.format(channel[2], op,
+                                                    reference[2],
+                                                    channel[0])
+        line = self.plot(Ts, Rs, label=label)
+
+        linedict = self._get_linedict(line)
+        linedict['label'] = label
+        linedict['Ts'] = Ts
+        linedict['Rs'] = Rs
+        linedict['channel'] = channel[2]
+        linedict['comparison'] = (channel, reference, mode)
+        if self.decimate:
+            self.redecimate_line(linedict)
+
+        name, address, ch = channel
+        linedict['Tc'] = self.model[name]['boards'][address]['Tcs'][ch]
+
+        return linedict
+
     def _get_linedict(self, line):
         """
         Finds and returns the line dictionary in self.lines that
         contains the specified line.
         """
-        if (isinstance(line, dict) and
-            (line in self.lines)):
-            return line
+        # Compare by identity; the line dictionaries hold data arrays,
+        # which do not support == comparisons
         for linedict in self.lines:
-            if line in linedict.itervalues():
+            if (line is linedict) or (line is linedict['line']):
                 ld = linedict
         try:
             return ld
         except NameError:
             raise HKEPlotterLineDoesNotExistError(line)
 
+    def sorted_index(self, line):
+        """
+        Returns the temperature-sorted order of the samples of an
+        R vs T line and the sorted temperatures. They are computed
+        once and stored in the line dictionary.
+        """
+        ld = self._get_linedict(line)
+        if 'Torder' not in ld:
+            order = argsort(ld['Ts'], kind='mergesort')
+            ld['Torder'] = order
+            ld['Tsorted'] = ld['Ts'][order]
+        return ld['Torder'], ld['Tsorted']
+
+    def _connect_limits(self):
+        """
+        Subscribe to changes of the axes limits, to redecimate the
+        lines for the new view.
+        """
+        self.axes.callbacks.connect('xlim_changed', self._onlimits)
+        self.axes.callbacks.connect('ylim_changed', self._onlimits)
+
+    def _onlimits(self, axes):
+        """
+        Schedule a redecimation of the lines. Panning changes the
+        limits on every mouse motion, so the redecimation is delayed
+        until the limits have not changed for redecimatedelay ms.
+        """
+        if (not self.decimate) or self._holdlimits:
+            return
+        canvas = self.figure.canvas
+        if canvas is None:
+            self.redecimate()
+            return
+        # The canvas is replaced whenever the GraphFrame is updated
+        if canvas is not self._redecimatecanvas:
+            self._redecimatetimer = canvas.new_timer(
+                interval=self.redecimatedelay)
+            self._redecimatetimer.add_callback(self._ontimer)
+            self._redecimatecanvas = canvas
+        self._redecimatetimer.stop()
+        self._redecimatetimer.start()
+
+    def _ontimer(self):
+        self._redecimatetimer.stop()
+        self.redecimate()
+        self.figure.canvas.draw_idle()
+
+    def redecimate(self):
+        """
+        Reslice the data of every R vs T line to the visible
+        temperature range at the resolution the axes can show. See
+        redecimate_line().
+        """
+        self._checkfigure()
+        for ld in self.lines:
+            if 'Ts' in ld:
+                self.redecimate_line(ld)
+
+    def redecimate_line(self, line):
+        """
+        Replace the drawn data of an R vs T line by the samples in the
+        visible temperature range. If there are more than
+        pointsperpixel samples per pixel column of the axes, they are
+        reduced by splitting them, in temperature order, into
+        equal-count buckets and keeping the lowest and highest
+        resistance of each, which preserves the envelope of the curve.
+        The samples are drawn in time order, so that the up and down
+        sweeps stay separate branches. The full data stay in the line
+        dictionary.
+        """
+        ld = self._get_linedict(line)
+        order, Tsorted = self.sorted_index(ld)
+        xmin, xmax = sorted(self.axes.get_xlim())
+        lo = searchsorted(Tsorted, xmin, side='left')
+        hi = searchsorted(Tsorted, xmax, side='right')
+        # Keep one sample beyond each edge so the line reaches the edges
+        lo = lo - 1 if lo > 0 else lo
+        hi = hi + 1 if hi < len(order) else hi
+        samples = order[lo:hi]
+
+        maxpoints = int(self.pointsperpixel*self.axes.bbox.width) or 1
+        if len(samples) > maxpoints:
+            samples = sort(self._minmax_samples(samples, ld['Rs'],
+                                                maxpoints//2 or 1))
+        else:
+            samples = self._extend_runs(sort(samples), len(order))
+
+        ld['line'].set_data(ld['Ts'][samples], ld['Rs'][samples])
+
+    def _extend_runs(self, samples, nsamples):
+        """
+        Returns the sorted sample indices samples with the samples
+        just before and after each run of consecutive indices added,
+        so that a line leaving the view and coming back is drawn on
+        out of the view rather than joined across it.
+        """
+        if not len(samples):
+            return samples
+        breaks = flatnonzero(diff(samples) > 1)
+        edges = concatenate(([samples[0] - 1], samples[breaks] + 1,
+                             samples[breaks + 1] - 1, [samples[-1] + 1]))
+        edges = edges[(edges >= 0) & (edges < nsamples)]
+        return union1d(samples, edges)
+
+    def _minmax_samples(self, samples, Rs, nbuckets):
+        """
+        Split samples into nbuckets equal-count buckets and return the
+        samples with the lowest and highest Rs in each, keeping the
+        order of samples.
+        """
+        size = len(samples)//nbuckets
+        nfull = size*nbuckets
+        buckets = samples[:nfull].reshape(nbuckets, size)
+        bucketRs = Rs[buckets]
+        rows = arange(nbuckets)
+        imin = bucketRs.argmin(axis=1)
+        imax = bucketRs.argmax(axis=1)
+        # Positions within samples, so that sorting restores the order
+        positions = concatenate((rows*size + imin, rows*size + imax))
+        tail = samples[nfull:]
+        if len(tail):
+            positions = concatenate((positions,
+                                     [nfull + Rs[tail].argmin(),
+                                      nfull + Rs[tail].argmax()]))
+        positions = unique(positions)
+        return samples[positions]
+
+    def build_cursor_index(self):
+        """
+        Bin the visible samples of every R vs T line by the screen
+        pixel they fall on, for use by nearest_point(). Only one sample
+        per pixel is kept, since they are indistinguishable on screen,
+        and the pixels are sorted so that they can be searched in
+        O(log n). Must be redone after the view changes, before the
+        next call to nearest_point().
+        """
+        self._checkfigure()
+        trans = self.axes.transData
+        bbox = self.axes.bbox
+        height = int(bbox.height) + 1
+        width = int(bbox.width) + 1
+        xmin, xmax = sorted(self.axes.get_xlim())
+
+        for ld in self.lines:
+            if 'Ts' not in ld:
+                continue
+            # Only the samples in the visible temperature range
+            order, Tsorted = self.sorted_index(ld)
+            lo = searchsorted(Tsorted, xmin, side='left')
+            hi = searchsorted(Tsorted, xmax, side='right')
+            samples = order[lo:hi]
+
+            xy = trans.transform(column_stack((ld['Ts'][samples],
+                                               ld['Rs'][samples])))
+            ok = isfinite(xy).all(axis=1)
+            samples, xy = samples[ok], xy[ok]
+            ix = floor(xy[:, 0] - bbox.x0).astype(int)
+            iy = floor(xy[:, 1] - bbox.y0).astype(int)
+            ok = (ix >= 0) & (ix < width) & (iy >= 0) & (iy < height)
+
+            keys = ix[ok]*height + iy[ok]
+            keys, first = unique(keys, return_index=True)
+            ld['cursor'] = (keys, samples[ok][first], height)
+
+    def nearest_point(self, x, y, radius=5):
+        """
+        Find the sample of any R vs T line nearest to the screen
+        position (x, y), in pixels, within radius pixels. Returns a
+        dictionary with the 'T', 'R', 'channel', 'label', sample
+        'index' and 'line' dictionary of the sample, or None if there
+        is no sample nearby. build_cursor_index() must have been
+        called since the last change of view.
+        """
+        bbox = self.axes.bbox
+        ix = int(floor(x - bbox.x0))
+        iy = int(floor(y - bbox.y0))
+
+        best = None
+        for ld in self.lines:
+            if 'cursor' not in ld:
+                continue
+            keys, samples, height = ld['cursor']
+            ylo = iy - radius if iy > radius else 0
+            yhi = iy + radius + 1 if iy + radius + 1 < height else height
+
+            # The pixels within radius are radius*2 + 1 runs of
+            # consecutive keys, one per pixel column
+            candidates = []
+            for dx in range(-radius, radius + 1):
+                base = (ix + dx)*height
+                lo, hi = searchsorted(keys, [base + ylo, base + yhi])
+                candidates.append(arange(lo, hi))
+            candidates = concatenate(candidates)
+            if not len(candidates):
+                continue
+
+            kx = keys[candidates] // height
+            ky = keys[candidates] % height
+            d2 = (kx - ix)**2 + (ky - iy)**2
+            j = d2.argmin()
+            if (best is None) or (d2[j] < best[0]):
+                best = (d2[j], ld, samples[candidates[j]])
+
+        if best is None:
+            return None
+        d2, ld, i = best
+        return {'T': ld['Ts'][i], 'R': ld['Rs'][i],
+                'channel': ld.get('channel'), 'label': ld['label'],
+                'index': i, 'line': ld}
+
     def addTcline(self, line, temperature=None):
         """
         Add a vertical line corresponding to line at the specified
@@ -210,6 +653,35 @@ class HKEPlotter(object):
             vline.remove()
         ld['vlines'] = []
 
+    def mark_transitions(self, line, name, address, grid, **kwargs):
+        """
+        Mark every transition of line found by HKEModel.transitions
+        with a dotted vertical line. The channel is that of line, in
+        board address of model item name; kwargs are passed on to
+        HKEModel.transitions. Returns the transitions of the channel.
+        """
+        self._checkfigure()
+        ld = self._get_linedict(line)
+        self.unmark_transitions(ld)
+        transitions = self.model.transitions(name, address, grid, **kwargs)
+        mine = transitions['channel'] == ld['channel']
+        color = ld['line'].get_c()
+        for T in transitions['T'][mine]:
+            tline = self.axes.axvline(T, color=color, ls=':')
+            ld['tlines'].append(tline)
+        return dict((key, transitions[key][mine])
+                    for key in ('T', 'height', 'width'))
+
+    def unmark_transitions(self, line):
+        """
+        Remove the transition markers of line.
+        """
+        self._checkfigure()
+        ld = self._get_linedict(line)
+        for tline in ld.get('tlines', []):
+            tline.remove()
+        ld['tlines'] = []
+
     def highlight_line(self, line, factor=1.5):
         """
         Highlight a line by making its linewidth slightly larger.
@@ -237,9 +709,10 @@ class HKEPlotter(object):
         self._checkfigure()
         ld = self._get_linedict(line)
         self.delTcline(ld)
+        self.unmark_transitions(ld)
         line = ld['line']
         line.remove()
-        self.lines.remove(ld)
+        self.lines = [l for l in self.lines if l is not ld]
 
     def update_lines(self):
         """
@@ -269,33 +742,170 @@ class HKEPlotter(object):
                 hline.set_linestyle('--')
                 hline.set_linewidth(lw)
 
-    def xscale(self, newscale, linthreshx=1.e-4):
+            for tline in ld['tlines']:
+                tline.set_color(color)
+                tline.set_linewidth(lw)
+
+    def xscale(self, newscale, linthreshx=None):
         """
-        Change the scale of the x axis.
+        Change the scale of the x axis. If linthreshx is None, the
+        symlog threshold is chosen by auto_thresholds.
         """
         self._checkfigure()
+        if linthreshx is None:
+            linthreshx = self.auto_thresholds()[0]
         if newscale == 'symlog':
-            self.axes.set_xscale(newscale, linthreshx=linthreshx)
+            kwargs = {'linthreshx': linthreshx}
         else:
-            self.axes.set_xscale(newscale)
+            kwargs = {}
+        # Always followed by autorange(), which redecimates
+        self._holdlimits = True
+        try:
+            self.axes.set_xscale(newscale, **kwargs)
+        finally:
+            self._holdlimits = False
+        self.scales['x'] = (newscale, kwargs)
 
-    def yscale(self, newscale, linthreshy=1.e-4):
+    def yscale(self, newscale, linthreshy=None):
         """
-        Change the scale of the y axis.
+        Change the scale of the y axis. If linthreshy is None, the
+        symlog threshold is chosen by auto_thresholds.
         """
         self._checkfigure()
+        if linthreshy is None:
+            linthreshy = self.auto_thresholds()[1]
         if newscale == 'symlog':
-            self.axes.set_yscale(newscale, linthreshy=linthreshy)
+            kwargs = {'linthreshy': linthreshy}
         else:
-            self.axes.set_yscale(newscale)
+            kwargs = {}
+        self._holdlimits = True
+        try:
+            self.axes.set_yscale(newscale, **kwargs)
+        finally:
+            self._holdlimits = False
+        self.scales['y'] = (newscale, kwargs)
 
     def autorange(self):
         """
         Automatically adjusts the range of the x and y axes to fit the
-        data.
+        data, and turns autoscaling back on, so that new lines adjust
+        it again. See auto_limits.
+        """
+        self._checkfigure()
+        self.axes.set_autoscale_on(True)
+        self._holdlimits = True
+        try:
+            if self.lines:
+                self.auto_limits()
+            else:
+                self.axes.autoscale_view(True)
+        finally:
+            self._holdlimits = False
+        if self.lines and self.decimate:
+            self.redecimate()
+
+    def line_stats(self, line):
+        """
+        Returns the statistics of a line used to choose the axes
+        limits and symlog thresholds: the range of its temperatures
+        ('Tmin', 'Tmax') and resistances ('Rmin', 'Rmax'), its 'noise'
+        floor and its 'Tc' (or None). R vs T lines take them from the
+        summary computed when the file was loaded (see
+        HKEModel.summary); otherwise they are computed from the line's
+        data once and stored in the line dictionary.
+        """
+        ld = self._get_linedict(line)
+        if 'stats' not in ld:
+            if 'Ts' in ld:
+                Ts, Rs = asarray(ld['Ts']), asarray(ld['Rs'])
+            else:
+                Ts = asarray(ld['line'].get_xdata())
+                Rs = asarray(ld['line'].get_ydata())
+            good = isfinite(Ts) & isfinite(Rs)
+            Ts, Rs = Ts[good], Rs[good]
+            stats = {'Tmin': nan, 'Tmax': nan, 'Rmin': nan, 'Rmax': nan,
+                     'noise': nan, 'Tc': ld.get('Tc')}
+            if len(Rs):
+                valid = Ts[Ts > 0]
+                if len(valid):
+                    stats['Tmin'], stats['Tmax'] = valid.min(), valid.max()
+                stats['Rmin'], stats['Rmax'] = Rs.min(), Rs.max()
+            if len(Rs) > 1:
+                stats['noise'] = 1.4826*median(abs(diff(Rs)))/sqrt(2.)
+            ld['stats'] = stats
+        return ld['stats']
+
+    def auto_limits(self, x=True, y=True):
+        """
+        Set the limits of the x axis, if x is True, and of the y axis,
+        if y is True, from the statistics of the lines (see
+        line_stats), in time proportional to the number of lines. The
+        axes' autoscaling setting is left unchanged.
+
+        The temperature range spans the Tcs, padded on either side by
+        their spread (at least 0.1 K), or the temperatures of the lines
+        if none has a Tc. The resistance range spans the resistances
+        of the lines, padded by 5%. Returns the limits.
         """
         self._checkfigure()
-        self.axes.autoscale_view(True)
+        stats = [self.line_stats(ld) for ld in self.lines]
+        if not stats:
+            return
+        Tcs = array([s['Tc'] for s in stats if s['Tc'] is not None],
+                    dtype=float64)
+        Tcs = Tcs[isfinite(Tcs)]
+        Tmins = array([s['Tmin'] for s in stats])
+        Tmaxs = array([s['Tmax'] for s in stats])
+        Rmins = array([s['Rmin'] for s in stats])
+        Rmaxs = array([s['Rmax'] for s in stats])
+
+        if len(Tcs):
+            tcmin, tcmax = Tcs.min(), Tcs.max()
+            delta = tcmax - tcmin if tcmax - tcmin > .1 else .1
+            xlim = [tcmin - delta, tcmax + delta]
+        else:
+            xlim = [nanmin(Tmins), nanmax(Tmaxs)]
+        Rmin, Rmax = nanmin(Rmins), nanmax(Rmaxs)
+        pad = .05*(Rmax - Rmin) or .05*abs(Rmax) or 1.
+        ylim = [Rmin - pad, Rmax + pad]
+
+        # Log axes cannot show nonpositive limits
+        if self.scales['x'][0] == 'log' and xlim[0] <= 0:
+            xlim[0] = nanmin(Tmins)
+        if self.scales['y'][0] == 'log' and ylim[0] <= 0:
+            positive = Rmins[Rmins > 0]
+            ylim[0] = positive.min() if len(positive) else ylim[1]*1.e-3
+
+        if x and all(isfinite(xlim)):
+            self.axes.set_xlim(xlim, auto=None)
+        if y and all(isfinite(ylim)):
+            self.axes.set_ylim(ylim, auto=None)
+        return xlim, ylim
+
+    def auto_thresholds(self):
+        """
+        Returns the symlog thresholds (linthreshx, linthreshy) suited
+        to the lines, from their statistics (see line_stats).
+        linthreshx is the power of ten below the spread of the Tcs (at
+        least 0.1 K), the span auto_limits pads the Tcs by. linthreshy
+        is the power of ten below the highest noise floor, as in
+        dewartools.groupplot.
+        """
+        stats = [self.line_stats(ld) for ld in self.lines]
+        Tcs = array([s['Tc'] for s in stats if s['Tc'] is not None],
+                    dtype=float64)
+        Tcs = Tcs[isfinite(Tcs)]
+        noise = array([s['noise'] for s in stats], dtype=float64)
+        noise = noise[isfinite(noise) & (noise > 0)]
+
+        delta = Tcs.max() - Tcs.min() if len(Tcs) else 0.
+        delta = delta if delta > .1 else .1
+        linthreshx = 10**floor(log10(delta))
+        if len(noise):
+            linthreshy = 10**floor(log10(noise.max()))
+        else:
+            linthreshy = 1.e-4
+        return linthreshx, linthreshy
 
     def legend(self, loc=None):
         """
@@ -303,12 +913,14 @@ class HKEPlotter(object):
         """
         self._checkfigure()
         self.axes.legend(loc=loc)
+        self.legendloc = loc
 
     def hide_legend(self):
         """
         Hide the legend.
         """
         self._checkfigure()
+        self.legendloc = None
         leg = self.axes.get_legend()
         if leg:
             leg.set_visible(False)
@@ -318,28 +930,187 @@ class HKEPlotter(object):
         Set the title.
         """
         self._checkfigure()
-        self.axes.set_title(title)
+        self._labelaxes().set_title(title)
 
     def xlabel(self, xlabel):
         """
         Set the x label.
         """
         self._checkfigure()
-        self.axes.set_xlabel(xlabel)
+        self._labelaxes().set_xlabel(xlabel)
 
     def ylabel(self, ylabel):
         """
         Set the y label.
         """
         self._checkfigure()
-        self.axes.set_ylabel(ylabel)
+        self._labelaxes().set_ylabel(ylabel)
 
-    def savefig(self, filename, dpi=300):
+    def savefig(self, filename, dpi=300, simplify=True, tolerance=1.,
+                rasterize_above=50000):
         """
         Save a figure to disk with the specified filename.
+
+        Vector formats (PDF, SVG, EPS) are written with lines of more
+        than rasterize_above samples rasterized, and, unless simplify
+        is False, with the lines simplified to within tolerance pixels
+        at dpi. See hkefigures.render_state.
+        """
+        self._checkfigure()
+        ext = os.path.splitext(filename)[1].lower()
+        if ext in vectorformats:
+            render_state(self.get_state(), filename, dpi=dpi,
+                         simplify=simplify, tolerance=tolerance,
+                         rasterize_above=rasterize_above)
+        else:
+            self.figure.savefig(filename, dpi=dpi)
+
+    def get_state(self):
+        """
+        Returns a picklable description of the current figure (its
+        lines, Tc lines, heatmap, labels, scales, limits and legend),
+        from which hkefigures.render_state can redraw it in another
+        process.
+
+        R vs T lines are described by their full data, in time order,
+        rather than the decimated data drawn on screen. The arrays are
+        referenced, not copied, so states are cheap to keep. While a
+        heatmap is shown, it is described instead of the R vs T axes.
         """
         self._checkfigure()
-        self.figure.savefig(filename, dpi=dpi)
+        axes = self._labelaxes()
+        shown = self.lines
+        scales = self.scales
+        legendloc = self.legendloc
+        if self.heatmap is not None:
+            shown = []
+            scales = {'x': ('linear', {}), 'y': ('linear', {})}
+            legendloc = None
+
+        lines = []
+        for ld in shown:
+            line = ld['line']
+            if 'Ts' in ld:
+                x, y = ld['Ts'], ld['Rs']
+            else:
+                x, y = line.get_xdata(), line.get_ydata()
+            vlines = [(vl.get_xdata()[0], vl.get_color(), vl.get_linewidth())
+                      for vl in ld['vlines']]
+            tlines = [(tl.get_xdata()[0], tl.get_color(), tl.get_linewidth())
+                      for tl in ld['tlines']]
+            lines.append({'x': asarray(x), 'y': asarray(y),
+                          'color': line.get_color(),
+                          'linewidth': line.get_linewidth(),
+                          'linestyle': line.get_linestyle(),
+                          'label': line.get_label(),
+                          'vlines': vlines,
+                          'tlines': tlines})
+
+        heatmap = None
+        if self.heatmap is not None:
+            hm = self.heatmap
+            scatter = hm['scatter']
+            if scatter is not None:
+                offsets = asarray(scatter.get_offsets())
+                Tcs = (offsets[:, 0], offsets[:, 1])
+            else:
+                Tcs = ([], [])
+            heatmap = {'image': hm['image'], 'edges': hm['edges'],
+                       'rowlabels': hm['rowlabels'],
+                       'cmap': hm['artist'].get_cmap().name,
+                       'clim': hm['artist'].get_clim(), 'Tcs': Tcs}
+
+        return {'figsize': tuple(self.figure.get_size_inches()),
+                'lines': lines,
+                'title': axes.get_title(),
+                'xlabel': axes.get_xlabel(),
+                'ylabel': axes.get_ylabel(),
+                'xscale': scales['x'],
+                'yscale': scales['y'],
+                'xlim': axes.get_xlim(),
+                'ylim': axes.get_ylim(),
+                'legend': legendloc,
+                'heatmap': heatmap}
+
+    def export_csv(self, filename, lines=None, columns=('label', 'T', 'R'),
+                   decimate=1, chunksize=2**16):
+        """
+        Write the temperatures and resistances of the specified lines
+        (by default all R vs T lines) to the CSV file filename.
+
+        The data are streamed to disk chunksize rows at a time, so
+        memory use does not grow with the length of the lines. columns
+        selects and orders the columns written, out of 'label',
+        'index' (the sample index), 'T' and 'R'. Only every decimate-th
+        sample is written.
+
+        Returns a dictionary of the number of rows and bytes written,
+        the time taken and the throughput in MB/s.
+        """
+        if lines is None:
+            lines = [ld for ld in self.lines if 'Ts' in ld]
+        lines = [self._get_linedict(line) for line in lines]
+
+        start = time.time()
+        nrows = 0
+        fmts = {'index': '%d', 'T': '%.9g', 'R': '%.9g'}
+        datacols = [col for col in columns if col != 'label']
+        fmt = ','.join(fmts[col] for col in datacols)
+        with open(filename, 'wb') as f:
+            f.write(','.join(columns) + '\n')
+            for ld in lines:
+                Ts, Rs = ld['Ts'], ld['Rs']
+                # The label is the same on every row, so it is added to
+                # the formatted rows rather than to the data (or to
+                # fmt, where a '%' in it would break savetxt)
+                label = '"{0}"'.format(ld['label'].replace('"', '""'))
+
+                step = chunksize*decimate
+                for i in range(0, len(Ts), step):
+                    Tchunk = Ts[i:i+step:decimate]
+                    Rchunk = Rs[i:i+step:decimate]
+                    indices = arange(i, i + step, decimate)[:len(Tchunk)]
+                    sources = {'index': indices, 'T': Tchunk, 'R': Rchunk}
+                    if datacols:
+                        block = column_stack([sources[col]
+                                              for col in datacols])
+                        buf = StringIO()
+                        savetxt(buf, block, fmt=fmt)
+                        text = buf.getvalue()
+                    else:
+                        text = '\n'*len(indices)
+                    if 'label' in columns:
+                        text = self._insert_column(
+                            text, label, list(columns).index('label'),
+                            len(datacols))
+                    f.write(text)
+                    nrows += len(indices)
+            nbytes = f.tell()
+        elapsed = time.time() - start
+
+        return {'rows': nrows, 'bytes': nbytes, 'seconds': elapsed,
+                'MB/s': nbytes/1.e6/(elapsed or 1.e-9)}
+
+    def _insert_column(self, text, value, k, ncols):
+        """
+        Returns the CSV rows text, each of ncols comma-separated
+        fields, with the string value inserted as field k of every
+        row.
+        """
+        if not text:
+            return text
+        if ncols == 0:
+            return text.replace('\n', value + '\n')
+        if k == 0:
+            return value + ',' + text[:-1].replace('\n', '\n' + value +
+                                                   ',') + '\n'
+        if k == ncols:
+            return text.replace('\n', ',' + value + '\n')
+        rows = []
+        for row in text.splitlines():
+            fields = row.split(',', k)
+            rows.append(','.join(fields[:k] + [value] + fields[k:]))
+        return '\n'.join(rows) + '\n'
 
     def draw(self):
         """
@@ -389,6 +1160,19 @@ initialized: {toadd}'.format(toadd=toadd)
         return self.msg
 
 
+class HKEPlotterNoChannelsError(HKEPlotterError):
+    """
+    An error indicating that there are no channels with data to draw.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.msg = 'There are no channels with data to draw in \
+{n}.'.format(n=self.name)
+
+    def __str__(self):
+        return self.msg
+
+
 class HKEPlotterLineDoesNotExistError(HKEPlotterError):
     """
     An error indicating that the HKEPlotter does not recognize the
@@ -2,14 +2,23 @@
 The Model Panel for the HKE Plotter program's main panel.
 """
 import os
+import threading
+import Queue
 import wx
 import wx.lib.filebrowsebutton as wxfbb
 import wx.lib.agw.ultimatelistctrl as ulc
-from hkeplotmodel import HKEPlotError
+import wx.lib.newevent
+from hkeplotmodel import HKEPlotError, HKEPlotLoadCancelledError, \
+                        HKECancelToken
 from hkeconfig import HKEConfig
 from HKEBinaryLibrary import HKEBinaryError
 
 
+# Events posted from the LoadWorker thread to the GUI thread
+LoadProgressEvent, EVT_LOAD_PROGRESS = wx.lib.newevent.NewEvent()
+LoadDoneEvent, EVT_LOAD_DONE = wx.lib.newevent.NewEvent()
+
+
 class ModelPanel(wx.Panel):
     """
     The data management panel.
@@ -25,6 +34,11 @@ class ModelPanel(wx.Panel):
         self.populate_top()
         self.preload_files()
 
+        self.worker = LoadWorker(self, self.fmf.model)
+        self.worker.start()
+        self.Bind(EVT_LOAD_PROGRESS, self.onLoadProgress)
+        self.Bind(EVT_LOAD_DONE, self.onLoadDone)
+
     def create_sizers(self):
         """
         Create the sizers in the panel.
@@ -107,15 +121,27 @@ class ModelPanel(wx.Panel):
 
         self.bLoad = wx.Button(self, -1, label='Load file')
 
+        # Progress of loads running in the background
+        self.bsProgress = wx.BoxSizer(wx.HORIZONTAL)
+        self.lblProgress = wx.StaticText(self, -1, label='Idle')
+        self.gProgress = wx.Gauge(self, -1, range=100)
+        self.bCancel = wx.Button(self, -1, label='Cancel')
+        self.bCancel.Enable(False)
+        self.bsProgress.Add(self.lblProgress, 1, wx.ALIGN_CENTER_VERTICAL)
+        self.bsProgress.Add(self.gProgress, 2, wx.EXPAND)
+        self.bsProgress.Add(self.bCancel, 0, wx.EXPAND)
+
         self.bsLoad.Add(self.fbbFileBrowser, 1, wx.EXPAND | wx.BOTTOM)
         self.bsLoad.Add(self.fbbCalFileBrowser, 1,
                         wx.EXPAND | wx.BOTTOM)
         self.bsLoad.Add(self.bsBoards, 1, wx.EXPAND | wx.BOTTOM)
         self.bsLoad.Add(self.bLoad, 1, wx.EXPAND | wx.TOP)
+        self.bsLoad.Add(self.bsProgress, 1, wx.EXPAND | wx.TOP)
 
         sizer.Add(self.bsLoad, 1, wx.EXPAND)
 
         self.Bind(wx.EVT_BUTTON, self.onLoadButton, self.bLoad)
+        self.Bind(wx.EVT_BUTTON, self.onCancelButton, self.bCancel)
         self.Bind(wx.EVT_CHECKBOX, self.onOverwriteCheckBox,
                   self.chkOverwrite)
 
@@ -141,27 +167,68 @@ class ModelPanel(wx.Panel):
             boardfname = self.fbbBoardFileBrowser.GetValue()
         else:
             boardfname = None
-        try:
-            model.loadfile(fname, calfname, bcfgfile=boardfname,
-                           handleerrors=False)
-        except (HKEPlotError, HKEBinaryError, IOError) as e:
-            errtxt = str(e)
-            dlg = wx.MessageDialog(self, errtxt,
+
+        # Read the file in the background; the model is only updated
+        # once the load completes, in onLoadDone
+        self.worker.submit(fname, calfname, bcfgfile=boardfname)
+        self.bCancel.Enable(True)
+
+    def onCancelButton(self, event):
+        self.worker.cancel()
+
+    def onLoadProgress(self, event):
+        """
+        Update the progress display from a LoadWorker progress event.
+        """
+        name = os.path.basename(event.filename)
+        if event.address is None:
+            label = "{0}: {1}".format(name, event.stage)
+        else:
+            label = "{0}: {1} (board {2})".format(name, event.stage,
+                                                  event.address)
+        self.lblProgress.SetLabel(label)
+        self.gProgress.SetValue(int(100*event.fraction))
+
+    def onLoadDone(self, event):
+        """
+        Add a successfully loaded file to the model, or report why the
+        load failed.
+        """
+        self.worker.finished()
+        if self.worker.pending() == 0:
+            self.bCancel.Enable(False)
+            self.gProgress.SetValue(0)
+
+        if event.cancelled:
+            self.lblProgress.SetLabel('Cancelled')
+            return
+        if event.error is not None:
+            self.lblProgress.SetLabel('Failed')
+            dlg = wx.MessageDialog(self, event.error,
                                    "Failed to load file",
                                    (wx.OK | wx.ICON_INFORMATION))
             dlg.ShowModal()
             dlg.Destroy()
             return
 
+        model = self.fmf.model
+        name = model.add_datafile(event.name, event.datafile)
+        self.lblProgress.SetLabel('Loaded ' + name)
+
         # Update the listctrl with the newly added data file
-        name = model.keys()[-1]
-        df = model[name]
+        self.append_datafile(name)
+        HKEConfig.add_loaded_file(model[name], name=name)
+
+    def append_datafile(self, name):
+        """
+        Add a row for the model item name to the listctrl.
+        """
+        df = self.fmf.model[name]
         fname2 = df['filename']
         dewar = df['dewar']
         description = df['description']
         row = [name, fname2, dewar, description]
         self.lctrlData.Append(row)
-        HKEConfig.add_loaded_file(df, name=name)
 
         self.adjustColumnSizes()
 
@@ -196,20 +263,12 @@ class ModelPanel(wx.Panel):
             taddress = int(d['temperature address'])
             tchannel = int(d['temperature channel'])
             try:
-                model.loadfile(absname, calname, description=desc)#, #DELME?
-                               # taddress=taddress, tchannel=tchannel)
+                model.loadfile(absname, calname, description=desc,
+                               taddress=taddress, tchannel=tchannel)
                 model.rename(-1, propername)
 
                 # Update the listctrl with the newly added data file
-                name = model.keys()[-1]
-                df = model[name]
-                fname2 = df['filename']
-                dewar = df['dewar']
-                description = df['description']
-                row = [name, fname2, dewar, description]
-                self.lctrlData.Append(row)
-
-                self.adjustColumnSizes()
+                self.append_datafile(model.keys()[-1])
             except (HKEPlotError, HKEBinaryError) as e:
                 errtxt = str(e)
                 dlg = wx.MessageDialog(self, errtxt,
@@ -254,6 +313,87 @@ class ModelPanel(wx.Panel):
         self.lctrlData.SetColumnWidth(column, size)
 
 
+class LoadWorker(threading.Thread):
+    """
+    A worker thread that reads data files queued by the GUI, so that
+    decoding and Tc computation do not block the event loop.
+
+    Progress and completion are posted to notify as LoadProgressEvent
+    and LoadDoneEvent events. The model itself is never modified by
+    the worker; the GUI adds the result of a successful load in its
+    LoadDoneEvent handler.
+    """
+    def __init__(self, notify, model):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.notify = notify
+        self.model = model
+        self.jobs = Queue.Queue()
+        self.token = HKECancelToken()
+        # Loads submitted whose LoadDoneEvent has not been handled yet.
+        # Only touched from the GUI thread, in submit() and finished().
+        self.inflight = 0
+
+    def submit(self, fname, calfname, **kwargs):
+        """
+        Queue a file to be read. kwargs are passed on to
+        HKEModel.readfile().
+        """
+        self.inflight += 1
+        self.jobs.put((fname, calfname, kwargs))
+
+    def finished(self):
+        """
+        Record that the LoadDoneEvent of a load has been handled. Must
+        be called from the LoadDoneEvent handler.
+        """
+        self.inflight -= 1
+
+    def pending(self):
+        """
+        The number of submitted loads, including the one running, whose
+        LoadDoneEvent has not yet been handled.
+        """
+        return self.inflight
+
+    def cancel(self):
+        """
+        Cancel the load currently running.
+        """
+        self.token.cancel()
+
+    def run(self):
+        while True:
+            fname, calfname, kwargs = self.jobs.get()
+            self.token.reset()
+            self.load(fname, calfname, **kwargs)
+
+    def load(self, fname, calfname, **kwargs):
+        def progress(stage, address, fraction):
+            event = LoadProgressEvent(filename=fname, stage=stage,
+                                      address=address,
+                                      fraction=fraction)
+            wx.PostEvent(self.notify, event)
+
+        result = {'filename': fname, 'name': None, 'datafile': None,
+                  'error': None, 'cancelled': False}
+        try:
+            name, df = self.model.readfile(fname, calfname,
+                                           handleerrors=False,
+                                           progress=progress,
+                                           cancel=self.token, **kwargs)
+            result['name'] = name
+            result['datafile'] = df
+        except HKEPlotLoadCancelledError:
+            result['cancelled'] = True
+        except Exception as e:
+            # Anything else must still be reported, or the worker
+            # thread dies silently
+            result['error'] = str(e)
+        wx.PostEvent(self.notify, LoadDoneEvent(**result))
+
+
 class HKEListCtrl(ulc.UltimateListCtrl):
     """
     The list control for displaying the loaded data files.
@@ -386,6 +526,15 @@ class HKEListCtrl(ulc.UltimateListCtrl):
         name = self.GetItem(selected, 0).GetText()
         model = self.fmf.model
 
+        if model[name]['metadata'] is None:
+            msg = ("{0} was loaded from an archive and has no data file "
+                   "to select registers from.".format(name))
+            dlg = wx.MessageDialog(self, msg, "Cannot change registers",
+                                   (wx.OK | wx.ICON_INFORMATION))
+            dlg.ShowModal()
+            dlg.Destroy()
+            return
+
         dlg = RegistersDialog(self, wx.ID_ANY, name, model,
                               title='Source Registers')
 
@@ -396,12 +545,22 @@ class HKEListCtrl(ulc.UltimateListCtrl):
             treg = dlg.chTemp.GetString(dlg.chTemp.GetSelection())
             tch = int(dlg.chTchannel.GetString(dlg.chTchannel.GetSelection()))
             s1reg = dlg.chSide1.GetString(dlg.chSide1.GetSelection())
-            s2reg = dlg.chSide2.GetString(dlg.chSide2.GetSelection())
+            s2reg = None
+            if dlg.dewar == 'shiny':
+                s2reg = dlg.chSide2.GetString(dlg.chSide2.GetSelection())
 
-            model.change_sources(name, treg=treg, tch=tch,
-                                 s1reg=s1reg, s2reg=s2reg)
-            df = model[name]
-            HKEConfig.add_loaded_file(df)
+            try:
+                model.change_sources(name, treg=treg, tch=tch,
+                                     s1reg=s1reg, s2reg=s2reg)
+            except HKEPlotError as e:
+                errdlg = wx.MessageDialog(self, str(e),
+                                          "Failed to change registers",
+                                          (wx.OK | wx.ICON_INFORMATION))
+                errdlg.ShowModal()
+                errdlg.Destroy()
+            else:
+                df = model[name]
+                HKEConfig.add_loaded_file(df, name=name)
 
         dlg.Destroy()
 
@@ -514,8 +673,8 @@ class RegistersDialog(wx.Dialog):
         self.model = model
         self.dataname = dataname
         self.dewar = self.model[dataname]['dewar']
-        self.f = self.model[self.dataname]['file']
-        self.registers = self.f.list_registers()
+        self.metadata = self.model[self.dataname]['metadata']
+        self.registers = self.metadata.registers
 
         self.bsMain = wx.BoxSizer(wx.VERTICAL)
 
@@ -605,8 +764,7 @@ class RegistersDialog(wx.Dialog):
     def update_tchannel(self):
         oldsel = self.chTchannel.GetSelection()
         tsel = self.chTemp.GetSelection()
-        data = self.f.get_data(tsel)
-        nch = data.shape[-1]
+        nch = self.metadata.nchannels(tsel)
         newchoices = [str(i) for i in range(nch)]
 
         self.chTchannel.Clear()
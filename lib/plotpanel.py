@@ -2,15 +2,27 @@
 The Plot Panel for the HKE Plotter program's main panel.
 """
 
+import os
+import re
 import wx
 import wx.lib.agw.ultimatelistctrl as ulc
 from hkeplotter import HKEPlotterError
+from hkefigures import FigureExporter
+from hkeplotmodel import HKEPlotError
+from hkecompare import HKEComparison
 
 
 class PlotPanel(wx.Panel):
     """
     The plot creation panel.
     """
+    # The channel summary fields the channels can be sorted and
+    # filtered by, see HKEModel.summary
+    sortfields = [('Channel', 'channel'), ('Tc', 'Tc'), ('Min R', 'minR'),
+                  ('Max R', 'maxR'), ('Normal R', 'normalR'),
+                  ('Noise', 'noise')]
+    filterpattern = re.compile(r'^\s*(\w+)\s*(<=|>=|==|!=|<|>)\s*(\S+)\s*$')
+
     def __init__(self, parent):
         wx.Panel.__init__(self, parent=parent, id=wx.ID_ANY,
                           style=wx.WANTS_CHARS)
@@ -18,6 +30,17 @@ class PlotPanel(wx.Panel):
         self.fmf = self.GetTopLevelParent()
         self.plotter = self.fmf.plotter
         self.graphframe = self.fmf.graphframe
+        self.redraws = RedrawScheduler(self.redraw)
+        # Axes whose symlog threshold was edited since the last redraw;
+        # they are rescaled by the redraw rather than on every keystroke
+        self.rethresh = set()
+
+        # Figures stored for saving later, as (name, state) pairs, and
+        # the background workers that save them
+        self.storedfigs = []
+        self.exporter = FigureExporter()
+        self.exporttimer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.onExportTimer, self.exporttimer)
 
         self.create_sizers()
         self.populate_top()
@@ -59,14 +82,32 @@ class PlotPanel(wx.Panel):
         bsIndices, self.lboxIndices = self.make_listbox('Indices',
                                                         wx.LB_EXTENDED)
 
+        # Sorting and filtering of the channels by their summaries
+        bsSort = wx.BoxSizer(wx.HORIZONTAL)
+        self.choSort = wx.Choice(self, wx.ID_ANY,
+                                 choices=[label for label, field
+                                          in self.sortfields])
+        self.choSort.SetSelection(0)
+        self.chkDescending = wx.CheckBox(self, wx.ID_ANY, 'Desc')
+        bsSort.Add(self.choSort, 1, wx.EXPAND)
+        bsSort.Add(self.chkDescending, 0, wx.ALIGN_CENTER_VERTICAL)
+        self.txtFilter = wx.TextCtrl(self, wx.ID_ANY,
+                                     style=wx.TE_PROCESS_ENTER)
+        self.txtFilter.SetToolTipString("Filter the channels, e.g. "
+                                        "'Tc > 0.5, noise < 1e-3'")
+        bsIndices.Add(bsSort, 0, wx.EXPAND)
+        bsIndices.Add(self.txtFilter, 0, wx.EXPAND)
+
         # Tc checkbox and Plot button
         self.bsButtons = wx.BoxSizer(wx.VERTICAL)
         self.cbTcs = wx.CheckBox(self, wx.ID_ANY, "Show Tcs")
         self.cbTcs.SetValue(True)
         self.bPlot = wx.Button(self, wx.ID_ANY, "Plot")
+        self.bHeatmap = wx.Button(self, wx.ID_ANY, "Heatmap")
         self.bsButtons.Add(self.cbTcs, 1, (wx.EXPAND | wx.ALIGN_BOTTOM |
                                            wx.ALIGN_CENTER_VERTICAL))
         self.bsButtons.Add(self.bPlot, 1, wx.EXPAND | wx.ALIGN_TOP)
+        self.bsButtons.Add(self.bHeatmap, 1, wx.EXPAND | wx.ALIGN_TOP)
 
         # Populate sizer
         sizer.Add(bsFile, 1, wx.EXPAND | wx.ALIGN_CENTER_VERTICAL)
@@ -78,7 +119,11 @@ class PlotPanel(wx.Panel):
         self.Bind(wx.EVT_LISTBOX, self.onFileSelect, self.lboxFile)
         self.Bind(wx.EVT_LISTBOX, self.onKeySelect, self.lboxKey)
         self.Bind(wx.EVT_LISTBOX, self.onIndicesSelect, self.lboxIndices)
+        self.Bind(wx.EVT_CHOICE, self.onSortChannels, self.choSort)
+        self.Bind(wx.EVT_CHECKBOX, self.onSortChannels, self.chkDescending)
+        self.Bind(wx.EVT_TEXT_ENTER, self.onSortChannels, self.txtFilter)
         self.Bind(wx.EVT_BUTTON, self.onPlot, self.bPlot)
+        self.Bind(wx.EVT_BUTTON, self.onHeatmap, self.bHeatmap)
 
         self.lboxFile.Bind(wx.EVT_KEY_UP, self.onKeyUpFile)
         self.lboxKey.Bind(wx.EVT_KEY_UP, self.onKeyUpKey)
@@ -125,9 +170,15 @@ class PlotPanel(wx.Panel):
         self.bDelete = wx.Button(self, label='Delete')
         self.bClear = wx.Button(self, label='Clear All')
         self.bTc = wx.Button(self, label='Toggle Tc')
+        self.choCompare = wx.Choice(self, wx.ID_ANY,
+                                    choices=('Difference', 'Ratio'))
+        self.choCompare.SetSelection(0)
+        self.bCompare = wx.Button(self, label='Compare to Selected')
         self.bsControls.Add(self.bDelete, 1, wx.EXPAND)
         self.bsControls.Add(self.bClear, 1, wx.EXPAND)
         self.bsControls.Add(self.bTc, 1, wx.EXPAND)
+        self.bsControls.Add(self.choCompare, 1, wx.EXPAND)
+        self.bsControls.Add(self.bCompare, 1, wx.EXPAND)
 
         sizer.Add(self.lctrlLines, 1, wx.EXPAND)
         sizer.Add(self.bsControls, 0)
@@ -138,6 +189,7 @@ class PlotPanel(wx.Panel):
                   self.bClear)
         self.Bind(wx.EVT_BUTTON, self.lctrlLines.onToggleTc,
                   self.bTc)
+        self.Bind(wx.EVT_BUTTON, self.onCompare, self.bCompare)
 
         sizer.SetSizeHints(self)
 
@@ -165,9 +217,9 @@ class PlotPanel(wx.Panel):
                                         'X Thresh')
         self.lblYthresh = wx.StaticText(self, wx.ID_ANY,
                                         'Y Thresh')
-        self.txtXthresh = wx.TextCtrl(self, wx.ID_ANY, '1.e-4',
+        self.txtXthresh = wx.TextCtrl(self, wx.ID_ANY, 'auto',
                                       style=wx.TE_PROCESS_ENTER)
-        self.txtYthresh = wx.TextCtrl(self, wx.ID_ANY, '1.e-4',
+        self.txtYthresh = wx.TextCtrl(self, wx.ID_ANY, 'auto',
                                       style=wx.TE_PROCESS_ENTER)
         bsXthresh = wx.BoxSizer(wx.HORIZONTAL)
         bsYthresh = wx.BoxSizer(wx.HORIZONTAL)
@@ -232,7 +284,7 @@ class PlotPanel(wx.Panel):
                                         'Figure Name')
         bsFigName = wx.BoxSizer(wx.HORIZONTAL)
         self.txtFigName = wx.TextCtrl(self, wx.ID_ANY, 'Figure')
-        formats = ('.png', '.pdf', '.eps')
+        formats = ('.png', '.pdf', '.svg', '.eps')
         self.choFigFormat = wx.Choice(self, wx.ID_ANY,
                                       choices=formats)
         self.choFigFormat.SetSelection(0)
@@ -244,7 +296,18 @@ class PlotPanel(wx.Panel):
         self.bFigSave = wx.Button(self, label='Save Figure to Disk')
         self.bFigStore = wx.Button(self,
                                    label='Store Figure in Buffer')
-        self.bFigStore.Enable(False)
+        self.bFigSaveAll = wx.Button(self,
+                                     label='Save All Stored Figures')
+        self.lblExport = wx.StaticText(self, wx.ID_ANY,
+                                       'No figures stored')
+        bsExport = wx.BoxSizer(wx.HORIZONTAL)
+        self.bExportCSV = wx.Button(self, label='Export Data to CSV')
+        self.lblDecimate = wx.StaticText(self, wx.ID_ANY, 'Every')
+        self.spDecimate = wx.SpinCtrl(self, wx.ID_ANY, min=1,
+                                      max=1000000, initial=1)
+        bsExport.Add(self.bExportCSV, 1, wx.EXPAND)
+        bsExport.Add(self.lblDecimate, 0, wx.ALIGN_CENTER_VERTICAL)
+        bsExport.Add(self.spDecimate, 0, wx.EXPAND)
         self.bsFigs.Add(self.lblFigName, 0, wx.EXPAND)
         self.bsFigs.Add(bsFigName, 0, wx.EXPAND)
         self.bsFigs.Add(self.chkSameAsTitle, 0, wx.EXPAND)
@@ -252,6 +315,10 @@ class PlotPanel(wx.Panel):
         self.bsFigs.Add(self.bFigSave, 0, wx.EXPAND)
         self.bsFigs.Add((5, 5))
         self.bsFigs.Add(self.bFigStore, 0, wx.EXPAND)
+        self.bsFigs.Add(self.bFigSaveAll, 0, wx.EXPAND)
+        self.bsFigs.Add(self.lblExport, 0, wx.EXPAND)
+        self.bsFigs.Add((5, 5))
+        self.bsFigs.Add(bsExport, 0, wx.EXPAND)
 
         # Add them all to the general sizer
         sizer.Add(self.bsScale, 0, wx.EXPAND)
@@ -283,6 +350,8 @@ class PlotPanel(wx.Panel):
                   self.chkSameAsTitle)
         self.Bind(wx.EVT_BUTTON, self.onSaveFig, self.bFigSave)
         self.Bind(wx.EVT_BUTTON, self.onStoreFig, self.bFigStore)
+        self.Bind(wx.EVT_BUTTON, self.onSaveAllFigs, self.bFigSaveAll)
+        self.Bind(wx.EVT_BUTTON, self.onExportCSV, self.bExportCSV)
 
     def update_model(self):
         """
@@ -319,9 +388,39 @@ class PlotPanel(wx.Panel):
 
     def update_figure(self):
         """
-        Updates the figure in the graphframe.
+        Updates the figure in the graphframe immediately, including
+        any redraw scheduled with self.redraws.
+        """
+        self.redraws.cancel()
+        self.redraw()
+
+    def redraw(self, textonly=False):
+        """
+        Redraw the figure in the graphframe, first applying any edited
+        symlog thresholds. See GraphFrame.redraw.
+        """
+        if self.rethresh:
+            self.apply_thresholds()
+            textonly = False
+        self.graphframe.redraw(self.plotter.figure, textonly=textonly)
+
+    def apply_thresholds(self):
+        """
+        Rescale the symlog axes whose threshold was edited with the
+        thresholds now entered, and fit the range to the data.
         """
-        self.graphframe.replace_figure(self.plotter.figure)
+        rescaled = False
+        if ('x' in self.rethresh) and (self.rbXscale.GetSelection() == 2):
+            linthreshx = self.get_threshold(self.txtXthresh)
+            self.plotter.xscale('symlog', linthreshx=linthreshx)
+            rescaled = True
+        if ('y' in self.rethresh) and (self.rbYscale.GetSelection() == 2):
+            linthreshy = self.get_threshold(self.txtYthresh)
+            self.plotter.yscale('symlog', linthreshy=linthreshy)
+            rescaled = True
+        self.rethresh.clear()
+        if rescaled:
+            self.plotter.autorange()
 
     def onFileSelect(self, event):
         model = self.fmf.model
@@ -345,25 +444,81 @@ class PlotPanel(wx.Panel):
         self.SendSizeEvent()
 
     def onKeySelect(self, event):
+        self.fill_channels()
+
+    def onSortChannels(self, event):
+        self.fill_channels()
+
+    def fill_channels(self):
+        """
+        Fill the channel listbox with the channels of the selected
+        board, sorted and filtered by their summaries according to the
+        sort and filter controls.
+        """
         model = self.fmf.model
-        boardname = event.GetString()
+        boardname = self.lboxKey.GetStringSelection()
         filename = self.lboxFile.GetStringSelection()
+        if (filename not in model.keys()) or (' - ' not in boardname):
+            return
         df = model[filename]
 
         addr = int(boardname.split(' - ')[0])
         board = df['boards'][addr]
-        regstr = "{ch} - {name} ({type})"
+        if 'data' not in board:
+            self.clear_listbox(self.lboxIndices)
+            return
+        label, sortby = self.sortfields[self.choSort.GetSelection()]
+        try:
+            filters = self.parse_filters(self.txtFilter.GetValue())
+            channels = model.select_channels(
+                filename, addr, sortby=sortby,
+                descending=self.chkDescending.IsChecked(),
+                filters=filters)
+        except (ValueError, HKEPlotError):
+            wx.Bell()
+            return
+        summary = model.summary(filename, addr)
+
+        # Only tagged channels have registers, and can be plotted
+        registers = board['registers']
+        regstr = "{ch} - {name} ({type}) Tc {Tc:.4g} K"
         chs = []
-        for ch, reg in board['registers'].items():
+        for ch in channels:
+            if ch not in registers:
+                continue
+            reg = registers[ch]
             t = reg['type']
             n = reg['name']
-            chstr = regstr.format(ch=ch, name=n, type=t)
+            chstr = regstr.format(ch=ch, name=n, type=t,
+                                  Tc=summary['Tc'][ch])
             chs.append(chstr)
 
         self.clear_listbox(self.lboxIndices)
-        self.lboxIndices.InsertItems(chs, 0)
+        if chs:
+            self.lboxIndices.InsertItems(chs, 0)
         self.SendSizeEvent()
 
+    def parse_filters(self, text):
+        """
+        Returns the (field, op, value) filters described by text, a
+        comma-separated list of comparisons such as 'Tc > 0.5'. Raises
+        ValueError if a comparison cannot be parsed.
+        """
+        fields = dict((label.lower().replace(' ', ''), field)
+                      for label, field in self.sortfields)
+        fields.update((field.lower(), field)
+                      for label, field in self.sortfields)
+        filters = []
+        for term in text.split(','):
+            if not term.strip():
+                continue
+            match = self.filterpattern.match(term)
+            if not match or match.group(1).lower() not in fields:
+                raise ValueError("Cannot parse filter '{0}'.".format(term))
+            field, op, value = match.groups()
+            filters.append((fields[field.lower()], op, float(value)))
+        return filters
+
     def onIndicesSelect(self, event):
         pass
 
@@ -408,6 +563,7 @@ class PlotPanel(wx.Panel):
             linedict = self.plotter.RvsTPlot(df, addr, i,
                                              description=filedesc,
                                              Tcline=tcflag)
+            linedict['source'] = (filename, addr, i)
             description = ''
             if filedesc:
                 description = ' - ' + filedesc
@@ -482,6 +638,88 @@ class PlotPanel(wx.Panel):
         # self.update_legend()
         # self.update_figure()
 
+    def onHeatmap(self, event):
+        """
+        Draw the selected channels of the selected board, or all of
+        the listed ones if none is selected, as a heatmap over the
+        temperature range of the file.
+        """
+        model = self.fmf.model
+        filename = self.lboxFile.GetStringSelection()
+        boardname = self.lboxKey.GetStringSelection()
+        if not (filename and boardname):
+            return
+        addr = int(boardname.split(' - ', 1)[0])
+        chindices = self.lboxIndices.GetSelections()
+        if not chindices:
+            chindices = range(self.lboxIndices.GetCount())
+        chnames = [self.lboxIndices.GetString(i) for i in chindices]
+        channels = [(addr, int(chname.split(' - ', 1)[0]))
+                    for chname in chnames]
+
+        wx.BeginBusyCursor()
+        try:
+            Tmin, Tmax = HKEComparison(model).temperature_range(filename)
+            self.plotter.HeatmapPlot(filename, (Tmin, Tmax, 400),
+                                     channels=channels,
+                                     Tcs=self.cbTcs.GetValue())
+        except (HKEPlotError, HKEPlotterError) as e:
+            dlg = wx.MessageDialog(self, str(e), "Cannot draw heatmap",
+                                   (wx.OK | wx.ICON_ERROR))
+            dlg.ShowModal()
+            dlg.Destroy()
+            return
+        finally:
+            wx.EndBusyCursor()
+
+        xlabel = 'Temperature (K)'
+        self.plotter.xlabel(xlabel)
+        self.txtXlabel.ChangeValue(xlabel)
+        ylabel = 'Board:Channel'
+        self.plotter.ylabel(ylabel)
+        self.txtYlabel.ChangeValue(ylabel)
+        self.update_figure()
+
+    def onCompare(self, event):
+        """
+        Plot the difference or ratio of every plotted channel relative
+        to the selected one, on their common temperature range.
+        """
+        linelist = self.lctrlLines.linelist
+        selected = self.lctrlLines.GetFirstSelected()
+        if (selected < 0) or ('source' not in linelist[selected]):
+            return
+        reference = linelist[selected]['source']
+        channels = [ld['source'] for ld in linelist
+                    if ('source' in ld) and (ld['source'] != reference)]
+        if not channels:
+            return
+
+        mode = self.choCompare.GetStringSelection().lower()
+        comparison = HKEComparison(self.fmf.model)
+        wx.BeginBusyCursor()
+        try:
+            grid = comparison.common_grid(channels + [reference])
+            for channel in channels:
+                linedict = self.plotter.ComparisonPlot(comparison, channel,
+                                                       reference, grid,
+                                                       mode=mode)
+                name = channel[0]
+                dewar = str(self.fmf.model[name]['dewar'])
+                row = ['Comparison', name, dewar, linedict['label']]
+                self.lctrlLines.Append(row)
+                self.lctrlLines.linelist.append(linedict)
+        except HKEPlotError as e:
+            dlg = wx.MessageDialog(self, str(e), "Cannot compare",
+                                   (wx.OK | wx.ICON_ERROR))
+            dlg.ShowModal()
+            dlg.Destroy()
+        finally:
+            wx.EndBusyCursor()
+
+        self.lctrlLines.adjustColumnSizes()
+        self.update_legend()
+
     def onKeyUpFile(self, event):
         # Not functioning for some reason...
         # print "in onKeyUpFile"
@@ -500,16 +738,27 @@ class PlotPanel(wx.Panel):
     def onKeyUpIndices(self, event):
         pass
 
+    def get_threshold(self, txt):
+        """
+        Returns the symlog threshold entered in the text control txt,
+        or None to have the plotter choose it from the plotted lines
+        if it is blank or 'auto'. Invalid entries are reset to 'auto'.
+        """
+        value = txt.GetValue().strip()
+        if value.lower() in ('', 'auto'):
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            txt.ChangeValue('auto')
+            txt.SetInsertionPoint(-1)
+            return None
+
     def onXscale(self, event):
         scaledict = {0: 'linear', 1: 'log', 2: 'symlog'}
         selected = event.GetInt()
         newscale = scaledict[selected]
-        try:
-            linthreshx = float(self.txtXthresh.GetValue())
-        except ValueError:
-            linthreshx = 1.e-4
-            self.txtXthresh.ChangeValue('1.e-4')
-            self.txtXthresh.SetInsertionPoint(-1)
+        linthreshx = self.get_threshold(self.txtXthresh)
         self.plotter.xscale(newscale, linthreshx=linthreshx)
         self.plotter.autorange()
         self.update_figure()
@@ -518,43 +767,20 @@ class PlotPanel(wx.Panel):
         scaledict = {0: 'linear', 1: 'log', 2: 'symlog'}
         selected = event.GetInt()
         newscale = scaledict[selected]
-        try:
-            linthreshy = float(self.txtYthresh.GetValue())
-        except ValueError:
-            linthreshy = 1.e-4
-            self.txtYthresh.ChangeValue('1.e-4')
-            self.txtYthresh.SetInsertionPoint(-1)
+        linthreshy = self.get_threshold(self.txtYthresh)
         self.plotter.yscale(newscale, linthreshy=linthreshy)
         self.plotter.autorange()
         self.update_figure()
 
     def onXthresh(self, event):
-        print "in onXthresh" #DELME
-        xscale = self.rbXscale.GetSelection()
-        if xscale == 2:
-            try:
-                linthreshx = float(self.txtXthresh.GetValue())
-            except ValueError:
-                linthreshx = 1.e-4
-                self.txtXthresh.ChangeValue('1.e-4')
-                self.txtXthresh.SetInsertionPoint(-1)
-            self.plotter.xscale('symlog', linthreshx=linthreshx)
-            self.plotter.autorange()
-            self.update_figure()
+        if self.rbXscale.GetSelection() == 2:
+            self.rethresh.add('x')
+            self.redraws.schedule()
 
     def onYthresh(self, event):
-        print "in onYthresh" #DELME
-        yscale = self.rbYscale.GetSelection()
-        if yscale == 2:
-            try:
-                linthreshy = float(self.txtYthresh.GetValue())
-            except ValueError:
-                linthreshy = 1.e-4
-                self.txtYthresh.ChangeValue('1.e-4')
-                self.txtYthresh.SetInsertionPoint(-1)
-            self.plotter.yscale('symlog', linthreshy=linthreshy)
-            self.plotter.autorange()
-            self.update_figure()
+        if self.rbYscale.GetSelection() == 2:
+            self.rethresh.add('y')
+            self.redraws.schedule()
 
     def onLegendToggle(self, event):
         checked = event.IsChecked()
@@ -584,17 +810,17 @@ class PlotPanel(wx.Panel):
         if sameas:
             self.txtFigName.ChangeValue(title)
         self.plotter.title(title)
-        self.update_figure()
+        self.redraws.schedule(textonly=True)
 
     def onXlabel(self, event):
         xlabel = event.GetString()
         self.plotter.xlabel(xlabel)
-        self.update_figure()
+        self.redraws.schedule(textonly=True)
 
     def onYlabel(self, event):
         ylabel = event.GetString()
         self.plotter.ylabel(ylabel)
-        self.update_figure()
+        self.redraws.schedule(textonly=True)
 
     def onFigName(self, event):
         self.chkSameAsTitle.SetValue(False)
@@ -612,10 +838,157 @@ class PlotPanel(wx.Panel):
             figname = 'Figure'
         form = self.choFigFormat.GetStringSelection()
         tosave = figname + form
-        self.plotter.savefig(tosave, dpi=300)
+        self.export_figure(self.plotter.get_state(), tosave)
 
     def onStoreFig(self, event):
-        pass
+        figname = self.txtFigName.GetValue()
+        if figname == '':
+            figname = 'Figure'
+        self.storedfigs.append((figname, self.plotter.get_state()))
+        self.update_export_status()
+
+    def onSaveAllFigs(self, event):
+        """
+        Save every stored figure as PNG, PDF and SVG in a chosen
+        folder.
+        """
+        if not self.storedfigs:
+            return
+        dlg = wx.DirDialog(self, "Save stored figures to")
+        if dlg.ShowModal() != wx.ID_OK:
+            dlg.Destroy()
+            return
+        folder = dlg.GetPath()
+        dlg.Destroy()
+
+        for figname, state in self.storedfigs:
+            for form in ('.png', '.pdf', '.svg'):
+                tosave = os.path.join(folder, figname + form)
+                self.export_figure(state, tosave)
+
+        # The figures have been handed to the exporter, so the stored
+        # states, which hold references to the data, are released
+        self.storedfigs = []
+        self.update_export_status()
+
+    def export_figure(self, state, filename):
+        """
+        Queue a figure state to be saved to filename by the background
+        workers.
+        """
+        self.exporter.submit(state, filename, dpi=300)
+        self.update_export_status()
+        if not self.exporttimer.IsRunning():
+            self.exporttimer.Start(500)
+
+    def onExportTimer(self, event):
+        self.update_export_status()
+
+    def update_export_status(self):
+        """
+        Show the number of stored figures and the progress of the
+        figures being saved.
+        """
+        status = self.exporter.status()
+        done = status['done'] + status['failed']
+        total = done + status['pending']
+        text = "{0} figures stored".format(len(self.storedfigs))
+        if total:
+            text += "; saved {0}/{1}".format(done, total)
+        if status['failed']:
+            text += " ({0} failed)".format(status['failed'])
+            self.lblExport.SetToolTipString('\n'.join(
+                "{0}: {1}".format(f, e) for f, e in status['errors']))
+        self.lblExport.SetLabel(text)
+        if not status['pending']:
+            self.exporttimer.Stop()
+
+    def onExportCSV(self, event):
+        """
+        Export the data of the selected line, or of all lines if none
+        is selected, to a CSV file.
+        """
+        linelist = self.lctrlLines.linelist
+        selected = self.lctrlLines.GetFirstSelected()
+        if selected >= 0:
+            lines = [linelist[selected]]
+        else:
+            lines = linelist
+        if not lines:
+            return
+
+        figname = self.txtFigName.GetValue() or 'Figure'
+        dlg = wx.FileDialog(self, "Export data", defaultFile=figname +
+                            '.csv', wildcard="CSV files (*.csv)|*.csv",
+                            style=(wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT))
+        if dlg.ShowModal() != wx.ID_OK:
+            dlg.Destroy()
+            return
+        fname = dlg.GetPath()
+        dlg.Destroy()
+
+        decimate = self.spDecimate.GetValue()
+        wx.BeginBusyCursor()
+        try:
+            stats = self.plotter.export_csv(fname, lines, decimate=decimate)
+        finally:
+            wx.EndBusyCursor()
+
+        msg = ("Wrote {rows} rows ({mb:.1f} MB) in {s:.2f} s "
+               "({rate:.1f} MB/s).")
+        msg = msg.format(rows=stats['rows'], mb=stats['bytes']/1.e6,
+                         s=stats['seconds'], rate=stats['MB/s'])
+        dlg = wx.MessageDialog(self, msg, "Data exported",
+                               (wx.OK | wx.ICON_INFORMATION))
+        dlg.ShowModal()
+        dlg.Destroy()
+
+
+class RedrawScheduler(object):
+    """
+    Merges bursts of figure property changes, e.g. one per keystroke in
+    a text control, into a single redraw once no change has been
+    requested for delay ms.
+
+    The redraw is text-only if every change merged into it was. The
+    numbers of redraws requested and performed are counted in
+    self.requested and self.performed.
+    """
+    def __init__(self, redraw, delay=300):
+        self.redraw = redraw
+        self.delay = delay
+        self.timer = None
+        self.textonly = True
+        self.requested = 0
+        self.performed = 0
+
+    def schedule(self, textonly=False):
+        """
+        Request a redraw, calling redraw(textonly) after the idle
+        period.
+        """
+        self.requested += 1
+        self.textonly = self.textonly and textonly
+        if self.timer is None:
+            self.timer = wx.CallLater(self.delay, self.fire)
+        else:
+            self.timer.Restart(self.delay)
+
+    def cancel(self):
+        """
+        Drop the pending redraw, if any.
+        """
+        if self.timer is not None:
+            self.timer.Stop()
+            self.timer = None
+        self.textonly = True
+
+    def fire(self):
+        textonly = self.textonly
+        self.timer = None
+        self.textonly = True
+        self.performed += 1
+        self.redraw(textonly)
 
 
 class HKEListCtrl2(ulc.UltimateListCtrl):
@@ -654,6 +1027,8 @@ class HKEListCtrl2(ulc.UltimateListCtrl):
                                                  'Delete Item')
         self.miTc = self.mContextMenu.Append(wx.ID_ANY,
                                              'Toggle Tc Line')
+        self.miTransitions = self.mContextMenu.Append(wx.ID_ANY,
+                                                      'Toggle Transitions')
 
         # self.Bind(ulc.EVT_LIST_COL_RIGHT_CLICK, self.onContextMenu,
         #           self)
@@ -663,6 +1038,8 @@ class HKEListCtrl2(ulc.UltimateListCtrl):
         # self.Bind(wx.EVT_MENU, self.onChangeDesc, self.miChangeDesc)
         self.Bind(wx.EVT_MENU, self.onDelete, self.miDelete)
         self.Bind(wx.EVT_MENU, self.onToggleTc, self.miTc)
+        self.Bind(wx.EVT_MENU, self.onToggleTransitions,
+                  self.miTransitions)
 
     def onContextMenu(self, event):
         self.PopupMenu(self.mContextMenu)
@@ -673,14 +1050,12 @@ class HKEListCtrl2(ulc.UltimateListCtrl):
         the row index.
         """
         plotter = self.fmf.plotter
-        graphframe = self.fmf.graphframe
         line = self.linelist[rowindex]
         try:
             plotter.delete_line(line)
             self.DeleteItem(rowindex)
             del self.linelist[rowindex]
             self.plotpanel.update_legend()
-            graphframe.replace_figure(plotter.figure)
         except HKEPlotterError:
             pass
 
@@ -690,13 +1065,35 @@ class HKEListCtrl2(ulc.UltimateListCtrl):
         index.
         """
         plotter = self.fmf.plotter
-        graphframe = self.fmf.graphframe
         line = self.linelist[rowindex]
         if line['vlines']:
             plotter.delTcline(line)
         else:
             plotter.addTcline(line)
-        graphframe.replace_figure(plotter.figure)
+        self.plotpanel.update_figure()
+
+    def toggleTransitions(self, rowindex, nbins=400):
+        """
+        Toggle the markers of the transitions detected on the binned
+        data of the line specified by row index, binned onto nbins
+        bins across the temperature range of its file.
+        """
+        plotter = self.fmf.plotter
+        line = self.linelist[rowindex]
+        if 'source' not in line:
+            return
+        if line['tlines']:
+            plotter.unmark_transitions(line)
+        else:
+            name, addr, ch = line['source']
+            comparison = HKEComparison(self.fmf.model)
+            try:
+                Tmin, Tmax = comparison.temperature_range(name)
+                plotter.mark_transitions(line, name, addr,
+                                         (Tmin, Tmax, nbins))
+            except HKEPlotError:
+                return
+        self.plotpanel.update_figure()
 
     def highlightLine(self, rowindex):
         """
@@ -704,11 +1101,10 @@ class HKEListCtrl2(ulc.UltimateListCtrl):
         figure.
         """
         plotter = self.fmf.plotter
-        graphframe = self.fmf.graphframe
 
         line = self.linelist[rowindex]
         plotter.highlight_line(line)
-        graphframe.replace_figure(plotter.figure)
+        self.plotpanel.update_figure()
 
     def unhighlightLine(self, rowindex):
         """
@@ -716,11 +1112,10 @@ class HKEListCtrl2(ulc.UltimateListCtrl):
         figure.
         """
         plotter = self.fmf.plotter
-        graphframe = self.fmf.graphframe
 
         line = self.linelist[rowindex]
         plotter.unhighlight_line(line)
-        graphframe.replace_figure(plotter.figure)
+        self.plotpanel.update_figure()
 
     def onDelete(self, event):
         selected = self.GetFirstSelected()
@@ -732,6 +1127,8 @@ class HKEListCtrl2(ulc.UltimateListCtrl):
         nr.reverse()
         for i in nr:
             self.deleteLine(i)
+        self.fmf.plotter.clear_heatmap()
+        self.plotpanel.update_figure()
 
     def onDeselect(self, event):
         row = event.m_itemIndex
@@ -745,6 +1142,10 @@ class HKEListCtrl2(ulc.UltimateListCtrl):
         selected = self.GetFirstSelected()
         self.toggleTc(selected)
 
+    def onToggleTransitions(self, event):
+        selected = self.GetFirstSelected()
+        self.toggleTransitions(selected)
+
     def insert_test_data(self):
         """
         Insert some toy data for testing into the columns.